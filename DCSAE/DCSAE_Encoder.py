@@ -3,16 +3,26 @@ import torch
 import torchvision
 import math
 
+from DCSAE.DC_SAE import fuse_latent_heads
+from utils.data import load_image_folder
+from utils.data import make_loader
+from utils.runtime import autocast
+from utils.runtime import compile_function
+from utils.runtime import memory_format
+from utils.profiling import StepProfiler
+
 class DCSAE_Encoder(torch.nn.Module):
     def __init__(self,
                  n_latent: int,
                  n_chan: int,
-                 input_d: Tuple[int]) -> None:
+                 input_d: Tuple[int],
+                 settings: dict = None) -> None:
         super(DCSAE_Encoder, self).__init__()
         # Initializing the class variables
         self.n_latent = n_latent
         self.n_chan = n_chan
         self.input_d = input_d
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
 
         # Calculating the size of intermediate output of convolutional layers
         self.y_2, self.x_2 = self.get_layer_size(2)
@@ -84,43 +94,37 @@ class DCSAE_Encoder(torch.nn.Module):
         self.enc_dense3_af = torch.nn.LeakyReLU(0.1)
 
         # Latent Variables Calculation
-        self.enc_dense4_mu_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_mu_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_negative_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_negative_af = torch.nn.LeakyReLU(0.1)
+        # The means and log-variances of both heads are computed by a single layer whose output is laid out as
+        # [mu_positive | mu_negative | var_positive | var_negative]
+        self.enc_dense4 = torch.nn.Linear(250, 4 * self.n_latent)
+        self.enc_dense4_af = torch.nn.LeakyReLU(0.1)
 
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         # Convolutional Encoder Network
+        # The input of every BatchNorm layer is cast to float32 so that it never runs in bfloat16 under autocast
         z = x
         z = self.enc_conv1(z)
-        z = self.enc_conv1_bn(z)
+        z = self.enc_conv1_bn(z.float())
         z = self.enc_conv1_af(z)
-        z, self.indices1 = self.enc_conv1_pool(z)
+        z, _ = self.enc_conv1_pool(z)
 
         z = self.enc_conv2(z)
-        z = self.enc_conv2_bn(z)
+        z = self.enc_conv2_bn(z.float())
         z = self.enc_conv2_af(z)
-        z, self.indices2 = self.enc_conv2_pool(z)
+        z, _ = self.enc_conv2_pool(z)
 
         z = self.enc_conv3(z)
-        z = self.enc_conv3_bn(z)
+        z = self.enc_conv3_bn(z.float())
         z = self.enc_conv3_af(z)
-        z, self.indices3 = self.enc_conv3_pool(z)
+        z, _ = self.enc_conv3_pool(z)
 
         z = self.enc_conv4(z)
-        z = self.enc_conv4_bn(z)
+        z = self.enc_conv4_bn(z.float())
         z = self.enc_conv4_af(z)
-        z, self.indices4 = self.enc_conv4_pool(z)
+        z, _ = self.enc_conv4_pool(z)
 
         # Dense Encoder Bottleneck
-        z = z.view(z.size(0), -1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor
+        z = torch.flatten(z, 1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor, whatever its memory layout
         z = self.enc_dense1(z)
         z = self.enc_dense1_af(z)
 
@@ -139,38 +143,59 @@ class DCSAE_Encoder(torch.nn.Module):
             x_l = math.ceil((x_l - 2) / 2 + 1)
         return y_l, x_l
 
-    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_positive(z)
-        mu = self.enc_dense4_mu_positive_af(mu)
+    def latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        latent = self.enc_dense4(z)
+        latent = self.enc_dense4_af(latent)
 
-        var = self.enc_dense4_var_positive(z)
-        var = self.enc_dense4_var_positive_af(var)
+        # Splitting the fused output into views of (mu_positive, mu_negative, var_positive, var_negative)
+        # Explicit slices are used instead of chunk() because the backward of chunk() is miscompiled by torch.compile on CPU
+        n = self.n_latent
+        return latent[..., :n], latent[..., n:2*n], latent[..., 2*n:3*n], latent[..., 3*n:]
 
+    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        mu, _, var, _ = self.latent_calc(z)
         return mu, var
     
     def negative_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_negative(z)
-        mu = self.enc_dense4_mu_negative_af(mu)
+        # The fused layer is run as a whole and its output is sliced, which is cheaper than copying the rows of the negative head at every call
+        _, mu, _, var = self.latent_calc(z)
+        return mu, var
 
-        var = self.enc_dense4_var_negative(z)
-        var = self.enc_dense4_var_negative_af(var)
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # Checkpoints saved with four separate latent layers are converted to the fused layer transparently
+        return super(DCSAE_Encoder, self).load_state_dict(fuse_latent_heads(state_dict), *args, **kwargs)
 
-        return mu, var
+    def load_weights(self, weight_file: str) -> None:
+        # Loads the weights of the encoder-only network, or the encoder part of the weights of the full network (its decoder weights are ignored)
+        state_dict = fuse_latent_heads(torch.load(weight_file))
+        encoder_keys = self.state_dict().keys()
+        self.load_state_dict({key: value for key, value in state_dict.items() if key in encoder_keys})
     
     def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor]:
-        positive_mean, positive_logvar = self.positive_latent_calc(self.encode(x))
-        negative_mean, negative_logvar = self.negative_latent_calc(self.encode(x))
+        # The encoder trunk is run once and shared by both latent heads
+        z = self.encode(x)
+        positive_mean, negative_mean, positive_logvar, negative_logvar = self.latent_calc(z)
         return positive_mean, positive_logvar, negative_mean, negative_logvar
 
+    def negative_forward(self, x: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Only the encoder (no decoder) is run and only the negative head is returned, which is all that the CAMARADERIE features need
+        z = self.encode(x)
+        return self.negative_latent_calc(z)
+
     def testing(self,
                 data_path: str,
-                weight_file: str):
+                weight_file: str,
+                heads: str = 'both'):
+        # Heads
+        # 1. both : The means and standard deviations of the positive and of the negative head are returned
+        # 2. negative : Only the means and standard deviations of the negative head are kept and returned
         # Using cuda (GPU) if available
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print (f'Using device: {device}')
-        network = self.to(device)
-        network.load_state_dict(torch.load(weight_file))# Load weights from the .pt file
+        network = self.to(device, memory_format=memory_format(self.settings)) # The convolution weights use the layout of the images
+        network.load_weights(weight_file) # Load weights from the .pt file
         network.eval() # Set the network in evalution mode
+        forward = compile_function(network.forward if heads == 'both' else network.negative_forward, self.settings)
 
         # Defining Image Transformations
         # 1. Convert the input image to a PyTorch Tensor
@@ -187,40 +212,44 @@ class DCSAE_Encoder(torch.nn.Module):
                 torchvision.transforms.Resize(self.input_d)])
 
         # Applying image transformations to the input test dataset
-        dataset = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transforms)
+        dataset = load_image_folder(data_path, transforms, self.n_chan, self.input_d, self.settings)
 
         # Set up a Python iterable over the input test dataset
-        test_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=1,
-            shuffle=True,
-            drop_last=True)
-
-        final_input = []
-        final_positive_mean = []
-        final_negative_mean = []
-        final_positive_var = []
-        final_negative_var = []
-        final_class = []
-        for data in test_loader:
-            input, class_name = data
-            final_input.append(input)
-            final_class.append(int(class_name))
+        # The samples are read in the order of the dataset, so that row i of every output belongs to the file final_path[i]
+        test_loader = make_loader(dataset, self.settings.get("extract_batch_size", 64), False, self.settings)
+
+        # The outputs of every batch are written into preallocated (N x n_latent) tensors and the input images are not kept
+        n = len(dataset)
+        final_negative_mean = torch.empty((n, self.n_latent))
+        final_negative_var = torch.empty((n, self.n_latent))
+        if heads == 'both':
+            final_positive_mean = torch.empty((n, self.n_latent))
+            final_positive_var = torch.empty((n, self.n_latent))
+        start = 0
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
+        for input, _ in test_loader:
+            end = start + input.size(0)
             input = input.to(device)
-            with torch.no_grad():
-                positive_mean, positive_logvariance, negative_mean, negative_logvariance = network.forward(input)
-                final_positive_mean.append(positive_mean)
-                final_positive_var.append(torch.exp(positive_logvariance/2))
-                final_negative_mean.append(negative_mean)
-                final_negative_var.append(torch.exp(negative_logvariance/2))
-        
+            with torch.inference_mode(), autocast(self.settings):
+                if heads == 'both':
+                    positive_mean, positive_logvariance, negative_mean, negative_logvariance = forward(input)
+                    final_positive_mean[start:end] = positive_mean.float()
+                    final_positive_var[start:end] = torch.exp(positive_logvariance.float()/2)
+                else:
+                    negative_mean, negative_logvariance = forward(input)
+                final_negative_mean[start:end] = negative_mean.float()
+                final_negative_var[start:end] = torch.exp(negative_logvariance.float()/2)
+            start = end
+            profiler.step()
+        profiler.stop()
+
         result = dict()
-        result['final_input'] = final_input
-        result['final_class'] = final_class
-        result['final_positive_mean'] = final_positive_mean
-        result['final_positive_var'] = final_positive_var
+        result['final_path'] = [path for path, _ in dataset.samples]
+        result['final_class'] = list(dataset.targets)
+        if heads == 'both':
+            result['final_positive_mean'] = final_positive_mean
+            result['final_positive_var'] = final_positive_var
         result['final_negative_mean'] = final_negative_mean
         result['final_negative_var'] = final_negative_var
 
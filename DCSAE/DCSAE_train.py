@@ -1,3 +1,4 @@
+import functools
 import torch
 import torchvision
 import matplotlib.pyplot as plt
@@ -6,9 +7,14 @@ import os
 
 from DCSAE.DC_SAE import DCSAE
 from DCSAE.NumDC_SAE import NumDCSAE
+from DCSAE.DCSAE_Encoder import DCSAE_Encoder
+from DCSAE.NumDCSAE_Encoder import NumDCSAE_Encoder
+from utils.distributed import launch
+from utils.memory import MemoryStage
+from utils.sampling import sample_latent
 
 class DCSAE_Trainer:
-    def __init__(self, n_latent, alpha, beta, gamma, rho, n_chan, input_d, train_path, val_path, weights_path, hyperparameters_path):
+    def __init__(self, n_latent, alpha, beta, gamma, rho, n_chan, input_d, train_path, val_path, weights_path, hyperparameters_path, settings=None):
         super(DCSAE_Trainer, self).__init__()
         self.n_latent = n_latent
         self.alpha = alpha
@@ -17,8 +23,10 @@ class DCSAE_Trainer:
         self.rho = rho
         self.input_d = input_d
         self.n_chan = n_chan
-        self.num_epochs = 100
+        self.settings = settings if settings is not None else dict()
+        self.num_epochs = self.settings.get("epochs", 100)
         self.lr = 1e-4
+        self.batch_size = self.settings.get("batch_size", 1)
 
         self.dataset = train_path
         self.validation_dataset = val_path
@@ -33,7 +41,9 @@ class DCSAE_Trainer:
             self.gamma,
             self.rho,
             self.n_chan,
-            self.input_d
+            self.input_d,
+            self.batch_size,
+            self.settings
         )
         
     def train(self):
@@ -42,10 +52,16 @@ class DCSAE_Trainer:
         print(f'gamma={self.gamma}')
         print(f'rho={self.rho}')
         print(f'n_latent={self.n_latent}')
+        print(f'batch_size={self.batch_size}')
+        print(f'precision={self.settings.get("precision", "fp32")}')
         print(f'Using data set {self.dataset}')
 
         # Training the created VAE instance on the labelled dataset at Client A
-        self.ClientA_Network.train_self(
+        # With world_size > 1 the network is trained by several processes together, each on its own shard of the dataset
+        train_self = self.ClientA_Network.train_self
+        if self.settings.get("world_size", 1) > 1:
+            train_self = functools.partial(launch, train_self, self.settings)
+        train_self(
             data_path=self.dataset,
             val_path=self.validation_dataset,
             epochs=self.num_epochs,
@@ -54,27 +70,25 @@ class DCSAE_Trainer:
             hyperparameters_file = self.hyperparameters_path)
 
     def latent(self):
-        result = self.ClientA_Network.testing(data_path=self.dataset, weight_file=self.weights_path)
+        memory = MemoryStage(self.settings, 'latent')
+        memory.start()
+        # Only the encoder trunk and the negative head of the trained network are needed, the decoder is not run
+        encoder = DCSAE_Encoder(self.n_latent, self.n_chan, self.input_d, self.settings)
+        result = encoder.testing(data_path=self.dataset, weight_file=self.weights_path, heads='negative')
 
         ClientA_class = result["final_class"]
 
-        # Extracting latent space representation of each image in the training dataset
-        ClientA_Z = []
-        for i in range(len(result["final_negative_mean"])):
-            eps = torch.randn_like(result["final_negative_var"][i])
-            mean_cpu = result["final_negative_mean"][i].cpu().detach().numpy()
-            variance_cpu = result["final_negative_var"][i].cpu().detach().numpy()
-            eps = eps.cpu().detach().numpy()
-            z = mean_cpu + variance_cpu * eps
-            ClientA_Z.append(z)
+        # Extracting latent space representation of each image in the training dataset, in a single vectorized draw
+        ClientA_Z = sample_latent(result["final_negative_mean"], result["final_negative_var"], self.settings, stream=1)
 
+        memory.stop(len(ClientA_class))
         return ClientA_Z, ClientA_class
 
     def visualize(self, ClientA_Z, ClientA_class):
         colors = ['red','green']
-        for i in range(len(ClientA_Z)):
-            z = ClientA_Z[i]
-            plt.scatter(z[0][0], z[0][1], c=colors[ClientA_class[i]])
+        # With several draws per sample only the first one is plotted
+        Z = ClientA_Z if ClientA_Z.ndim == 2 else ClientA_Z[:, 0]
+        plt.scatter(Z[:, 0], Z[:, 1], c=[colors[c] for c in ClientA_class])
         plt.savefig("./latent.png", format="png")
     
     def reconstruct(self):
@@ -110,15 +124,17 @@ class DCSAE_Trainer:
             image.save(f'./Reconstruction/reconstruction_{i}.jpg')
 
 class NumDCSAE_Trainer:
-    def __init__(self, n_latent, alpha, beta, gamma, rho, train_data, val_data, train_labels, val_labels, weights_path, hyperparameters_path):
+    def __init__(self, n_latent, alpha, beta, gamma, rho, train_data, val_data, train_labels, val_labels, weights_path, hyperparameters_path, settings=None):
         super(NumDCSAE_Trainer, self).__init__()
         self.n_latent = n_latent
         self.alpha = alpha
         self.beta = beta
         self.gamma = gamma
         self.rho = rho
-        self.num_epochs = 100
+        self.settings = settings if settings is not None else dict()
+        self.num_epochs = self.settings.get("epochs", 100)
         self.lr = 1e-4
+        self.batch_size = self.settings.get("batch_size", 1)
 
         self.dataset = train_data
         self.validation_dataset = val_data
@@ -134,7 +150,9 @@ class NumDCSAE_Trainer:
             self.beta,
             self.gamma,
             self.rho,
-            self.dataset.shape[1]
+            self.dataset.shape[1],
+            self.batch_size,
+            self.settings
         )
         
     def train(self):
@@ -143,9 +161,15 @@ class NumDCSAE_Trainer:
         print(f'gamma={self.gamma}')
         print(f'rho={self.rho}')
         print(f'n_latent={self.n_latent}')
+        print(f'batch_size={self.batch_size}')
+        print(f'precision={self.settings.get("precision", "fp32")}')
 
         # Training the created VAE instance on the labelled dataset at Client A
-        self.ClientA_Network.train_self(
+        # With world_size > 1 the network is trained by several processes together, each on its own shard of the dataset
+        train_self = self.ClientA_Network.train_self
+        if self.settings.get("world_size", 1) > 1:
+            train_self = functools.partial(launch, train_self, self.settings)
+        train_self(
             train_data=self.dataset,
             val_data=self.validation_dataset,
             train_labels=self.train_labels,
@@ -156,25 +180,23 @@ class NumDCSAE_Trainer:
             hyperparameters_file = self.hyperparameters_path)
 
     def latent(self):
-        result = self.ClientA_Network.testing(test_data=self.dataset, labels=self.train_labels, weight_file=self.weights_path)
+        memory = MemoryStage(self.settings, 'latent')
+        memory.start()
+        # Only the encoder trunk and the negative head of the trained network are needed, the decoder is not run
+        encoder = NumDCSAE_Encoder(self.n_latent, self.dataset.shape[1], self.settings)
+        result = encoder.testing(test_data=self.dataset, labels=self.train_labels, weight_file=self.weights_path, heads='negative')
 
         ClientA_class = result["final_class"]
 
-        # Extracting latent space representation of each image in the training dataset
-        ClientA_Z = []
-        for i in range(len(result["final_negative_mean"])):
-            eps = torch.randn_like(result["final_negative_var"][i])
-            mean_cpu = result["final_negative_mean"][i].cpu().detach().numpy()
-            variance_cpu = result["final_negative_var"][i].cpu().detach().numpy()
-            eps = eps.cpu().detach().numpy()
-            z = mean_cpu + variance_cpu * eps
-            ClientA_Z.append(z)
+        # Extracting latent space representation of each image in the training dataset, in a single vectorized draw
+        ClientA_Z = sample_latent(result["final_negative_mean"], result["final_negative_var"], self.settings, stream=1)
 
+        memory.stop(len(ClientA_class))
         return ClientA_Z, ClientA_class
 
     def visualize(self, ClientA_Z, ClientA_class):
         colors = ['red','green']
-        for i in range(len(ClientA_Z)):
-            z = ClientA_Z[i]
-            plt.scatter(z[0], z[1], c=colors[ClientA_class[i]])
+        # With several draws per sample only the first one is plotted
+        Z = ClientA_Z if ClientA_Z.ndim == 2 else ClientA_Z[:, 0]
+        plt.scatter(Z[:, 0], Z[:, 1], c=[colors[c] for c in ClientA_class])
         plt.savefig("./latent.png", format="png")
\ No newline at end of file
@@ -1,8 +1,82 @@
 from typing import Tuple
 import torch
+import os
+import sys
 import torchvision
 import math
 
+from utils.data import load_image_folder
+from utils.data import make_loader
+from utils.checkpoint import CheckpointWriter
+from utils.checkpoint import TerminationHandler
+from utils.checkpoint import restore_training_state
+from utils.checkpoint import training_state
+from utils.checkpoint import training_state_path
+from utils.distributed import all_reduce_sum
+from utils.distributed import broadcast_flag
+from utils.distributed import distribute
+from utils.distributed import is_main_process
+from utils.distributed import shard
+from utils.distributed import set_epoch
+from utils.metrics import MetricsAggregator
+from utils.metrics import metrics_path
+from utils.runtime import autocast
+from utils.runtime import compile_function
+from utils.runtime import memory_format
+from utils.timing import PhaseTimer
+from utils.timing import timing_path
+from utils.memory import MemoryStage
+from utils.profiling import StepProfiler
+
+# Names of the four latent layers used by checkpoints saved before the latent heads were fused
+LATENT_HEADS = ['enc_dense4_mu_positive', 'enc_dense4_mu_negative', 'enc_dense4_var_positive', 'enc_dense4_var_negative']
+
+def fuse_latent_heads(state_dict: dict) -> dict:
+    if LATENT_HEADS[0] + '.weight' not in state_dict:
+        return state_dict
+
+    # Stacking the weights and biases of the four latent layers in the order of the fused layer's output
+    fused_dict = state_dict.copy()
+    for param in ['weight', 'bias']:
+        fused_dict['enc_dense4.' + param] = torch.cat([fused_dict.pop(head + '.' + param) for head in LATENT_HEADS])
+
+    metadata = getattr(state_dict, '_metadata', None)
+    if metadata is not None:
+        fused_dict._metadata = metadata
+    return fused_dict
+
+def latent_separation(mu: torch.Tensor, other_mu: torch.Tensor, class_name: torch.Tensor, rho: float, metric: str) -> torch.Tensor:
+    # Cheap measure of how well the two classes are separated in the latent space (higher is better)
+    # 1. distance : Mean distance between the mu of the two latent heads relative to rho, capped at 1 where the repulsion loss stops acting
+    # 2. centroid : Accuracy of a nearest-centroid classifier on the mu of the negative head, which is the representation used for classification
+    if metric == "distance":
+        return torch.clamp(torch.linalg.vector_norm(mu - other_mu, dim=-1) / rho, max=1).mean()
+    positive = (class_name == 1)
+    if positive.all() or not positive.any():
+        return torch.ones((), device=mu.device) # A single class is always separable
+    negative_mu = torch.where(positive.unsqueeze(-1), other_mu, mu)
+    centroids = torch.stack([negative_mu[~positive].mean(dim=0), negative_mu[positive].mean(dim=0)])
+    prediction = torch.cdist(negative_mu, centroids).argmin(dim=-1)
+    return (prediction == positive.long()).float().mean()
+
+def separation_subset(labels: torch.Tensor, samples: int, seed: int = 0) -> torch.Tensor:
+    # Validation samples on which the latent separation is measured, drawn once before training so that every epoch is measured on the same samples
+    # Every class contributes a seeded random share of its samples in proportion to its size (at least one sample), so the subset does not
+    # depend on the order of the dataset (ImageFolder and CSV files sorted by class)
+    # Returns the slot of every validation sample in the subset, -1 for the samples outside of it
+    labels = labels.long().cpu()
+    generator = torch.Generator().manual_seed(seed)
+    chosen = []
+    for label in torch.unique(labels):
+        indices = torch.nonzero(labels == label).flatten()
+        count = min(len(indices), max(1, round(samples * len(indices) / len(labels))))
+        chosen.append(indices[torch.randperm(len(indices), generator=generator)[:count]])
+    slots = torch.full((len(labels),), -1, dtype=torch.long)
+    if chosen:
+        chosen = torch.sort(torch.cat(chosen)).values
+        slots[chosen] = torch.arange(len(chosen))
+    return slots
+
 class DCSAE(torch.nn.Module):
     def __init__(self,
                  n_latent: int,
@@ -13,6 +87,7 @@ class DCSAE(torch.nn.Module):
                  n_chan: int,
                  input_d: Tuple[int],
                  batch: int = 1, 
+                 settings: dict = None,
                  ) -> None:
         super(DCSAE, self).__init__()
         # Initializing the class variables
@@ -22,6 +97,7 @@ class DCSAE(torch.nn.Module):
         self.gamma = gamma
         self.rho = rho
         self.batch = batch
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
         self.n_chan = n_chan
         self.input_d = input_d
 
@@ -30,6 +106,8 @@ class DCSAE(torch.nn.Module):
         self.delta = 1e-4
         self.best_score = None
         self.num_bad_epochs = 0
+        self.best_separation = None
+        self.num_bad_separation_epochs = 0
 
         # Calculating the size of intermediate output of convolutional layers
         self.y_2, self.x_2 = self.get_layer_size(2)
@@ -102,17 +180,10 @@ class DCSAE(torch.nn.Module):
         self.enc_dense3_af = torch.nn.LeakyReLU(0.1)
 
         # Latent Variables Calculation
-        self.enc_dense4_mu_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_mu_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_negative_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_negative_af = torch.nn.LeakyReLU(0.1)
+        # The means and log-variances of both heads are computed by a single layer whose output is laid out as
+        # [mu_positive | mu_negative | var_positive | var_negative]
+        self.enc_dense4 = torch.nn.Linear(250, 4 * self.n_latent)
+        self.enc_dense4_af = torch.nn.LeakyReLU(0.1)
 
         # Dense Decoder Bottleneck
         self.dec_dense4 = torch.nn.Linear(self.n_latent, 250)
@@ -175,31 +246,32 @@ class DCSAE(torch.nn.Module):
             x_l = math.ceil((x_l - 2) / 2 + 1)
         return y_l, x_l
 
-    def encode(self, x: torch.Tensor) -> torch.Tensor:
+    def encode(self, x: torch.Tensor) -> Tuple[torch.Tensor]:
         # Convolutional Encoder Network
+        # The input of every BatchNorm layer is cast to float32 so that it never runs in bfloat16 under autocast
         z = x
         z = self.enc_conv1(z)
-        z = self.enc_conv1_bn(z)
+        z = self.enc_conv1_bn(z.float())
         z = self.enc_conv1_af(z)
-        z, self.indices1 = self.enc_conv1_pool(z)
+        z, indices1 = self.enc_conv1_pool(z)
 
         z = self.enc_conv2(z)
-        z = self.enc_conv2_bn(z)
+        z = self.enc_conv2_bn(z.float())
         z = self.enc_conv2_af(z)
-        z, self.indices2 = self.enc_conv2_pool(z)
+        z, indices2 = self.enc_conv2_pool(z)
 
         z = self.enc_conv3(z)
-        z = self.enc_conv3_bn(z)
+        z = self.enc_conv3_bn(z.float())
         z = self.enc_conv3_af(z)
-        z, self.indices3 = self.enc_conv3_pool(z)
+        z, indices3 = self.enc_conv3_pool(z)
 
         z = self.enc_conv4(z)
-        z = self.enc_conv4_bn(z)
+        z = self.enc_conv4_bn(z.float())
         z = self.enc_conv4_af(z)
-        z, self.indices4 = self.enc_conv4_pool(z)
+        z, indices4 = self.enc_conv4_pool(z)
 
         # Dense Encoder Bottleneck
-        z = z.view(z.size(0), -1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor
+        z = torch.flatten(z, 1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor, whatever its memory layout
         z = self.enc_dense1(z)
         z = self.enc_dense1_af(z)
 
@@ -209,27 +281,48 @@ class DCSAE(torch.nn.Module):
         z = self.enc_dense3(z)
         z = self.enc_dense3_af(z)
 
-        return z
+        # The pooling indices are returned alongside the output since the decoder needs them for unpooling
+        return z, (indices1, indices2, indices3, indices4)
     
-    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_positive(z)
-        mu = self.enc_dense4_mu_positive_af(mu)
+    def latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        latent = self.enc_dense4(z)
+        latent = self.enc_dense4_af(latent)
 
-        var = self.enc_dense4_var_positive(z)
-        var = self.enc_dense4_var_positive_af(var)
+        # Splitting the fused output into views of (mu_positive, mu_negative, var_positive, var_negative)
+        # Explicit slices are used instead of chunk() because the backward of chunk() is miscompiled by torch.compile on CPU
+        n = self.n_latent
+        return latent[..., :n], latent[..., n:2*n], latent[..., 2*n:3*n], latent[..., 3*n:]
 
+    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        mu, _, var, _ = self.latent_calc(z)
         return mu, var
     
     def negative_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_negative(z)
-        mu = self.enc_dense4_mu_negative_af(mu)
-
-        var = self.enc_dense4_var_negative(z)
-        var = self.enc_dense4_var_negative_af(var)
-
+        _, mu, _, var = self.latent_calc(z)
         return mu, var
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # Checkpoints saved with four separate latent layers are converted to the fused layer transparently
+        return super(DCSAE, self).load_state_dict(fuse_latent_heads(state_dict), *args, **kwargs)
     
-    def decode(self, z: torch.Tensor) -> torch.Tensor:
+    def class_latent_calc(self, z: torch.Tensor, class_name: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Selecting the latent head of each sample in the batch on the basis of its class (0 : Negative, 1 : Positive)
+        # The head of the sample's own class is the "current" head and the head of the opposite class is the "other" head
+        positive_mu, negative_mu, positive_var, negative_var = self.latent_calc(z)
+        mask = (torch.as_tensor(class_name, device=z.device) == 1).unsqueeze(-1)
+
+        current_mu = torch.where(mask, positive_mu, negative_mu)
+        current_var = torch.where(mask, positive_var, negative_var)
+        other_mu = torch.where(mask, negative_mu, positive_mu)
+        other_var = torch.where(mask, negative_var, positive_var)
+
+        return current_mu, current_var, other_mu, other_var
+    
+    def decode(self, z: torch.Tensor, indices: Tuple[torch.Tensor]) -> torch.Tensor:
+        # The pooling indices are passed explicitly and all output sizes are derived from the batch dimension of the input
+        indices1, indices2, indices3, indices4 = indices
+        batch = z.size(0)
+
         # Dense Decoder Bottleneck
         y = self.dec_dense4(z)
         y = self.dec_dense4_af(y)
@@ -244,56 +337,79 @@ class DCSAE(torch.nn.Module):
         y = self.dec_dense1_af(y)
 
         # Convolutional Decoder Network
-        y = torch.reshape(y, [self.batch, 16, self.y_5, self.x_5]) # Converting the 1D tensor (output of dense layers) to a 4D tensor
+        # The input of every BatchNorm layer is cast to float32 so that it never runs in bfloat16 under autocast
+        y = torch.reshape(y, [batch, 16, self.y_5, self.x_5]) # Converting the 1D tensor (output of dense layers) to a 4D tensor
+        y = y.contiguous(memory_format=memory_format(self.settings)) # The only layout conversion of the decoder
         y = self.dec_conv4_pool(
             y,
-            self.indices4,
-            output_size=torch.Size([self.batch, 16, self.y_4, self.x_4]))
+            indices4,
+            output_size=torch.Size([batch, 16, self.y_4, self.x_4]))
         y = self.dec_conv4(y)
-        y = self.dec_conv4_bn(y)
+        y = self.dec_conv4_bn(y.float())
         y = self.dec_conv4_af(y)
 
         y = self.dec_conv3_pool(
             y,
-            self.indices3,
-            output_size=torch.Size([self.batch, 32, self.y_3, self.x_3]))
+            indices3,
+            output_size=torch.Size([batch, 32, self.y_3, self.x_3]))
         y = self.dec_conv3(y)
-        y = self.dec_conv3_bn(y)
+        y = self.dec_conv3_bn(y.float())
         y = self.dec_conv3_af(y)
 
         y = self.dec_conv2_pool(
             y,
-            self.indices2,
-            output_size=torch.Size([self.batch, 64, self.y_2, self.x_2]))
+            indices2,
+            output_size=torch.Size([batch, 64, self.y_2, self.x_2]))
         y = self.dec_conv2(y)
-        y = self.dec_conv2_bn(y)
+        y = self.dec_conv2_bn(y.float())
         y = self.dec_conv2_af(y)
 
         y = self.dec_conv1_pool(
             y,
-            self.indices1,
-            output_size=torch.Size([self.batch, 128, self.input_d[0], self.input_d[1]]))
+            indices1,
+            output_size=torch.Size([batch, 128, self.input_d[0], self.input_d[1]]))
         y = self.dec_conv1(y)
-        y = self.dec_conv1_bn(y)
+        y = self.dec_conv1_bn(y.float())
         y = self.dec_conv1_af(y)
 
         return y
     
-    def forward(self, x: torch.Tensor, class_name: int) -> Tuple[torch.Tensor]:
-        z = self.encode(x)
-
-        if class_name==0:
-            mu, logvar = self.negative_latent_calc(z)
-        else:
-            mu, logvar = self.positive_latent_calc(z)
+    def forward(self, x: torch.Tensor, class_name: torch.Tensor) -> Tuple[torch.Tensor]:
+        # The encoder trunk is run once and shared by both latent heads
+        z, indices = self.encode(x)
+        mu, logvar, other_mu, other_logvar = self.class_latent_calc(z, class_name)
 
         std = torch.exp(logvar / 2)
         eps = torch.randn_like(std)
         z = mu + std * eps
 
-        out = self.decode(z)
+        out = self.decode(z, indices)
 
-        return out, mu, logvar
+        return out, mu, logvar, other_mu, other_logvar
+    
+    def loss_calc(self,
+                  input: torch.Tensor,
+                  out: torch.Tensor,
+                  current_mu: torch.Tensor,
+                  current_logvar: torch.Tensor,
+                  other_mu: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Every loss term is computed per sample in float32 and then averaged over the batch
+        out, current_mu, current_logvar, other_mu = out.float(), current_mu.float(), current_logvar.float(), other_mu.float()
+
+        # KL-Divergence Loss (Regularization loss in VAE Loss function)
+        kl_loss = torch.mul(input=torch.sum(current_mu.pow(2) + current_logvar.exp() - current_logvar - 1, dim=-1), other=0.5)
+
+        # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
+        mse_loss = torch.nn.functional.mse_loss(out, input, reduction='none').flatten(1).mean(dim=1)
+
+        # Repulsion Loss (For increasing the distance between the clusters belonging to positive and negative classes)
+        distance = torch.sqrt(torch.sum(torch.square(current_mu-other_mu), dim=-1))
+        repulsion_loss = torch.clamp(self.rho-distance, min=0)**2/self.rho
+
+        # Total Loss =  (Alpha * Regularization Loss + Beta * Reconstruction Loss + Gamma * Repulsion Loss)/(Alpha + Beta + Gamma)
+        loss = (torch.mul(kl_loss, self.alpha) + torch.mul(mse_loss, self.beta) + torch.mul(repulsion_loss, self.gamma)) / (self.alpha + self.beta + self.gamma)
+
+        return loss.mean(), kl_loss.mean(), mse_loss.mean(), repulsion_loss.mean()
     
     def testing(self,
                 data_path: str,
@@ -301,9 +417,10 @@ class DCSAE(torch.nn.Module):
         # Using cuda if available
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print (f'Using device: {device}')
-        network = self.to(device)
+        network = self.to(device, memory_format=memory_format(self.settings)) # The convolution weights use the layout of the images
         network.load_state_dict(torch.load(weight_file)) # Load weights from the .pt file
         network.eval() # Set the network in evalution mode
+        forward = compile_function(network.forward, self.settings)
 
         # Defining Image Transformations
         # 1. Convert the input image to a PyTorch Tensor
@@ -320,16 +437,10 @@ class DCSAE(torch.nn.Module):
                 torchvision.transforms.Resize(self.input_d)])
 
         # Applying image transformations to the input test dataset
-        dataset = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transforms)
+        dataset = load_image_folder(data_path, transforms, self.n_chan, self.input_d, self.settings)
     
         # Set up a Python iterable over the input test dataset
-        test_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=self.batch,
-            shuffle=True,
-            drop_last=True)
+        test_loader = make_loader(dataset, self.batch, True, self.settings)
 
         final_input = []
         final_class = []
@@ -338,19 +449,24 @@ class DCSAE(torch.nn.Module):
         final_negative_mean = []
         final_positive_var = []
         final_negative_var = []
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
         for data in test_loader:
             input, class_name = data
-            final_input.append(input)
-            final_class.append(int(class_name))
+            final_input.extend(input.split(1))
+            final_class.extend(class_name.tolist())
             input = input.to(device)
-            with torch.no_grad():
-                output, current_mean, current_logvariance = network.forward(input, int(class_name))
-                other_output, other_mean, other_logvariance = network.forward(input, abs(int(class_name)-1))
-                final_positive_mean.append(current_mean)
-                final_positive_var.append(torch.exp(current_logvariance/2))
-                final_negative_mean.append(other_mean)
-                final_negative_var.append(torch.exp(other_logvariance/2))
-                final_output.append(output)
+            class_name = class_name.to(device)
+            with torch.no_grad(), autocast(self.settings):
+                output, current_mean, current_logvariance, other_mean, other_logvariance = forward(input, class_name)
+                # Splitting the batch so that every sample keeps its own entry in the result
+                final_positive_mean.extend(current_mean.float().split(1))
+                final_positive_var.extend(torch.exp(current_logvariance.float()/2).split(1))
+                final_negative_mean.extend(other_mean.float().split(1))
+                final_negative_var.extend(torch.exp(other_logvariance.float()/2).split(1))
+                final_output.extend(output.float().split(1))
+            profiler.step()
+        profiler.stop()
 
         result = dict()
         result['final_input'] = final_input
@@ -362,17 +478,58 @@ class DCSAE(torch.nn.Module):
         result['final_negative_var'] = final_negative_var
         return result
     
+    def validate(self, forward, val_loader, device: torch.device, slots: torch.Tensor = None) -> Tuple[float]:
+        # Sum of the per-sample reconstruction losses over the validation dataset
+        # The network is evaluated in evaluation mode, so BatchNorm uses its running statistics and they are not updated by the validation data
+        # Optionally, the latent separation of the classes is measured on the validation samples selected by separation_subset()
+        self.eval()
+        val_loss = torch.zeros((), device=device)
+        metric = self.settings.get("separation_metric", "none")
+        measure = metric != "none" and slots is not None and bool((slots >= 0).any())
+        if measure:
+            positions = shard(slots.to(device)) # Slots of the samples read by this process, in the order of the loader
+            subset = torch.zeros((int((slots >= 0).sum()), 2 * self.n_latent + 1), device=device) # mu, other_mu and class of every sample of the subset
+            offset = 0
+        with torch.inference_mode(), autocast(self.settings):
+            for input, class_name in val_loader:
+                input = input.to(device)
+                class_name = class_name.to(device)
+                output, mu, logvar, other_mu, other_logvar = forward(input, class_name)
+                val_loss += torch.nn.functional.mse_loss(output.float(), input) * input.size(0)
+                if measure:
+                    slot = positions[offset:offset+input.size(0)]
+                    keep = slot >= 0
+                    subset[slot[keep]] = torch.cat([mu.float(), other_mu.float(), class_name.float().unsqueeze(-1)], dim=-1)[keep]
+                    offset += input.size(0)
+        self.train()
+
+        separation = None
+        if measure:
+            subset = all_reduce_sum(subset) # Every sample of the subset is read by exactly one process
+            mu, other_mu, class_name = subset.split([self.n_latent, self.n_latent, 1], dim=-1)
+            separation = float(latent_separation(mu, other_mu, class_name.squeeze(-1).long(), self.rho, metric))
+        return float(all_reduce_sum(val_loss)), separation # Single synchronization with the device (and the other processes) per validation pass
+
+    def check_separation(self, curr_score) -> bool:
+        # Same plateau rule as check() for the latent separation, which is better when it is higher
+        if self.best_separation==None or curr_score-self.best_separation>self.delta:
+            self.best_separation = curr_score
+            self.num_bad_separation_epochs = 0
+        else:
+            self.num_bad_separation_epochs += 1
+        return self.num_bad_separation_epochs==(self.settings.get("separation_patience") or self.patience)
+
     def check(self, curr_score, model, weights_file) :
         if self.best_score==None:
             self.best_score = curr_score
             state_dict = model.state_dict()
-            torch.save(state_dict, weights_file)
+            self.checkpoint_writer.submit(state_dict, weights_file)
         else:
             if self.best_score-curr_score>self.delta:
                 self.best_score = curr_score
                 self.num_bad_epochs = 0
                 state_dict = model.state_dict()
-                torch.save(state_dict, weights_file)
+                self.checkpoint_writer.submit(state_dict, weights_file)
             else:
                 self.num_bad_epochs += 1
         if self.num_bad_epochs==self.patience:
@@ -392,7 +549,7 @@ class DCSAE(torch.nn.Module):
         print (f'Using device: {device}')
 
         # Set the network in training mode
-        network = self.to(device)
+        network = self.to(device, memory_format=memory_format(self.settings)) # The convolution weights use the layout of the images
         network.train()
 
         # Defining Image Transformations
@@ -410,28 +567,21 @@ class DCSAE(torch.nn.Module):
                 torchvision.transforms.Resize(self.input_d)])
 
         # Applying image transformations to the input training dataset
-        dataset = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transforms)
+        dataset = load_image_folder(data_path, transforms, self.n_chan, self.input_d, self.settings)
         
         # Applying image transformations to the input validation dataset
-        val_dataset = torchvision.datasets.ImageFolder(
-            root=val_path,
-            transform=transforms)
+        val_dataset = load_image_folder(val_path, transforms, self.n_chan, self.input_d, self.settings)
     
         # Sets up a Python iterable over the input training dataset
-        train_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=self.batch,
-            shuffle=True,
-            drop_last=True)
+        train_loader = make_loader(dataset, self.batch, True, self.settings)
 
         # Sets up a Python iterable over the input validation dataset
-        val_loader = torch.utils.data.DataLoader(
-            dataset=val_dataset,
-            batch_size=self.batch,
-            shuffle=True,
-            drop_last=True)
+        val_loader = make_loader(val_dataset, self.batch, False, self.settings)
+
+        # Validation samples on which the latent separation is measured
+        slots = None
+        if self.settings.get("separation_metric", "none") != "none":
+            slots = separation_subset(torch.as_tensor(val_dataset.targets), self.settings.get("separation_samples", 512))
 
         # Save the hyperparameters used for training the VAE Network
         hyperparameters = {}
@@ -442,51 +592,101 @@ class DCSAE(torch.nn.Module):
         hyperparameters["rho"] = self.rho
         hyperparameters["n_chan"] = self.n_chan
         hyperparameters["input_d"] = self.input_d
-        torch.save(hyperparameters, hyperparameters_file)
+        hyperparameters["precision"] = self.settings.get("precision", "fp32")
+        if is_main_process():
+            torch.save(hyperparameters, hyperparameters_file)
 
         # Using Adam Optimizer for training
         optimizer = torch.optim.Adam(network.parameters(), lr=learning_rate)
 
-        for epoch in range(epochs):
-            epoch_loss = 0
+        # The best weights found by early stopping are written to disk in the background
+        self.checkpoint_writer = CheckpointWriter()
+
+        # Continuing an interrupted run from its last full training state
+        state_file = training_state_path(weights_file)
+        start_epoch = 0
+        if self.settings.get("resume", False):
+            if os.path.exists(state_file):
+                start_epoch = restore_training_state(state_file, network, optimizer)
+                print(f'Resuming training from epoch {start_epoch} using {state_file}')
+            else:
+                print(f'No training state found at {state_file}, training from scratch')
+        checkpoint_every = self.settings.get("checkpoint_every", 1) # Epochs between two full training state checkpoints
+        termination = TerminationHandler()
+
+        # Per-epoch means of the loss components, printed and written next to the weights
+        metrics = MetricsAggregator(metrics_path(weights_file), append=start_epoch > 0)
+
+        # In data-parallel training the network is wrapped with DistributedDataParallel, which averages the gradients across the processes
+        model = distribute(network)
+
+        # A single training step (forward pass and loss), compiled as a whole with torch.compile when enabled
+        def train_step(input, class_name):
+            with autocast(self.settings):
+                out, current_mu, current_logvar, other_mu, other_logvar = model(input, class_name)
+            return network.loss_calc(input, out, current_mu, current_logvar, other_mu)
+        train_step = compile_function(train_step, self.settings)
+        forward = compile_function(network.forward, self.settings)
+        # Wall-clock time of every phase of training, written next to the weights
+        timer = PhaseTimer(device, timing_path(weights_file), append=start_epoch > 0, compiled=self.settings.get("compile", False))
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_train')
+        profiler.start()
+
+        for epoch in range(start_epoch, epochs):
+            memory = MemoryStage(self.settings, 'train_epoch', epoch=epoch)
+            memory.start()
+            timer.start_epoch()
+            set_epoch(train_loader, epoch)
             for data in train_loader:
                 input, class_name = data
                 input = input.to(device)
+                class_name = class_name.to(device)
+                timer.lap('data')
 
-                # Passing the input image through VAE Network
-                out, current_mu, current_logvar = network.forward(input, int(class_name))
-
-                if int(class_name)==1:
-                    other_mu, other_logvar = network.negative_latent_calc(network.encode(input))
-                else:
-                    other_mu, other_logvar = network.positive_latent_calc(network.encode(input))
-
-                # KL-Divergence Loss (Regularization loss in VAE Loss function)
-                kl_loss = torch.mul(input=torch.sum(current_mu.pow(2) + current_logvar.exp() - current_logvar - 1), other=0.5)
-
-                # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
-                mse_loss = torch.nn.functional.mse_loss(out, input)
-
-                # Repulsion Loss (For increasing the distance between the clusters belonging to positive and negative classes)
-                repulsion_loss = max(0, self.rho-torch.sqrt(torch.sum(torch.square(current_mu-other_mu))))**2/self.rho
-
-                # Total Loss =  (Alpha * Regularization Loss + Beta * Reconstruction Loss + Gamma * Repulsion Loss)/(Alpha + Beta + Gamma)
-                loss = (torch.mul(kl_loss, self.alpha) + torch.mul(mse_loss, self.beta) + torch.mul(repulsion_loss, self.gamma)) / (self.alpha + self.beta + self.gamma)
+                # Passing the input batch through VAE Network
+                loss, kl_loss, mse_loss, repulsion_loss = train_step(input, class_name)
+                timer.lap('forward')
 
                 optimizer.zero_grad() # Sets gradients of all model parameters to zero
                 loss.backward() # Perform Back-Propogation
+                timer.lap('backward')
                 optimizer.step() # Performs a single optimization step (parameter update)
-                epoch_loss += loss
-
-            val_loss = 0
-            for data in val_loader:
-                input, class_name = data
-                input = input.to(device)
-                output, mu, logvar = network.forward(input, int(class_name))
-                mse_val_loss = torch.nn.functional.mse_loss(output, input)
-                val_loss += mse_val_loss
-            if self.check(val_loss, network, weights_file):
+                timer.lap('optimizer')
+                profiler.step()
+                metrics.update(input.size(0), loss, KL=kl_loss, MSE=mse_loss, Repulsion=repulsion_loss)
+
+                # On SIGTERM the current state is saved and the interrupted epoch is run again when resuming
+                if termination.poll():
+                    if is_main_process():
+                        self.checkpoint_writer.submit(training_state(epoch, network, optimizer), state_file)
+                    self.checkpoint_writer.close()
+                    print(f'Training interrupted at epoch {epoch}, the training state was saved to {state_file}')
+                    sys.exit(143)
+                timer.lap('bookkeeping') # Metrics, profiler and SIGTERM poll of the step
+                timer.end_step(input.size(0))
+
+            val_loss, separation = self.validate(forward, val_loader, device, slots)
+            metrics.emit(epoch, val_loss, separation)
+            timer.lap('validation')
+            # Rank 0 decides on early stopping and writes the checkpoints, the other processes follow its decision
+            # When the latent separation is measured, training stops as soon as either the validation loss or the separation stops improving
+            stop = False
+            if is_main_process():
+                stop = self.check(val_loss, network, weights_file)
+                if separation is not None:
+                    stop = self.check_separation(separation) or stop
+            stop = broadcast_flag(stop)
+            if not stop and checkpoint_every > 0 and (epoch + 1) % checkpoint_every == 0 and is_main_process():
+                self.checkpoint_writer.submit(training_state(epoch + 1, network, optimizer), state_file)
+            timer.lap('checkpoint')
+            timer.end_epoch(epoch, epochs)
+            memory.stop(timer.samples)
+            if stop:
                 print(f'Early Stopping at epoch {epoch}')
                 break
-            print(f'Epoch: {epoch}; Training Loss: {epoch_loss}; Validation Loss: {val_loss}')
+        profiler.stop()
+        if is_main_process():
+            timer.report()
+        self.checkpoint_writer.close() # Waits until the best weights are on disk
+        termination.restore()
         print('Training finished, saving weights...')
\ No newline at end of file
@@ -1,14 +1,22 @@
 from typing import Tuple
 import torch
 
+from DCSAE.DC_SAE import fuse_latent_heads
+from utils.runtime import autocast
+from utils.runtime import chunk_rows
+from utils.runtime import compile_function
+from utils.profiling import StepProfiler
+
 class NumDCSAE_Encoder(torch.nn.Module):
     def __init__(self,
                  n_latent: int,
-                 input_size: int) -> None:
+                 input_size: int,
+                 settings: dict = None) -> None:
         super(NumDCSAE_Encoder, self).__init__()
         # Initializing the class variables
         self.n_latent = n_latent
         self.input_size = input_size
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
 
         # Dense Encoder Bottleneck
         self.enc_dense1 = torch.nn.Linear(self.input_size, 2048)
@@ -21,17 +29,10 @@ class NumDCSAE_Encoder(torch.nn.Module):
         self.enc_dense3_af = torch.nn.LeakyReLU(0.1)
 
         # Latent Variables Calculation
-        self.enc_dense4_mu_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_mu_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_negative_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_negative_af = torch.nn.LeakyReLU(0.1)
+        # The means and log-variances of both heads are computed by a single layer whose output is laid out as
+        # [mu_positive | mu_negative | var_positive | var_negative]
+        self.enc_dense4 = torch.nn.Linear(250, 4 * self.n_latent)
+        self.enc_dense4_af = torch.nn.LeakyReLU(0.1)
 
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         # Dense Encoder Bottleneck
@@ -46,64 +47,95 @@ class NumDCSAE_Encoder(torch.nn.Module):
 
         return z
 
-    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_positive(z)
-        mu = self.enc_dense4_mu_positive_af(mu)
+    def latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        latent = self.enc_dense4(z)
+        latent = self.enc_dense4_af(latent)
 
-        var = self.enc_dense4_var_positive(z)
-        var = self.enc_dense4_var_positive_af(var)
+        # Splitting the fused output into views of (mu_positive, mu_negative, var_positive, var_negative)
+        # Explicit slices are used instead of chunk() because the backward of chunk() is miscompiled by torch.compile on CPU
+        n = self.n_latent
+        return latent[..., :n], latent[..., n:2*n], latent[..., 2*n:3*n], latent[..., 3*n:]
 
+    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        mu, _, var, _ = self.latent_calc(z)
         return mu, var
     
     def negative_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_negative(z)
-        mu = self.enc_dense4_mu_negative_af(mu)
+        # The fused layer is run as a whole and its output is sliced, which is cheaper than copying the rows of the negative head at every call
+        _, mu, _, var = self.latent_calc(z)
+        return mu, var
 
-        var = self.enc_dense4_var_negative(z)
-        var = self.enc_dense4_var_negative_af(var)
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # Checkpoints saved with four separate latent layers are converted to the fused layer transparently
+        return super(NumDCSAE_Encoder, self).load_state_dict(fuse_latent_heads(state_dict), *args, **kwargs)
 
-        return mu, var
+    def load_weights(self, weight_file: str) -> None:
+        # Loads the weights of the encoder-only network, or the encoder part of the weights of the full network (its decoder weights are ignored)
+        state_dict = fuse_latent_heads(torch.load(weight_file))
+        encoder_keys = self.state_dict().keys()
+        self.load_state_dict({key: value for key, value in state_dict.items() if key in encoder_keys})
     
     def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor]:
-        positive_mean, positive_logvar = self.positive_latent_calc(self.encode(x))
-        negative_mean, negative_logvar = self.negative_latent_calc(self.encode(x))
+        # The encoder trunk is run once and shared by both latent heads
+        z = self.encode(x)
+        positive_mean, negative_mean, positive_logvar, negative_logvar = self.latent_calc(z)
         return positive_mean, positive_logvar, negative_mean, negative_logvar
 
+    def negative_forward(self, x: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Only the encoder (no decoder) is run and only the negative head is returned, which is all that the CAMARADERIE features need
+        z = self.encode(x)
+        return self.negative_latent_calc(z)
+
     def testing(self,
                 test_data: torch.Tensor,
                 labels: torch.Tensor,
-                weight_file: str):
+                weight_file: str,
+                heads: str = 'both'):
+        # Heads
+        # 1. both : The means and standard deviations of the positive and of the negative head are returned
+        # 2. negative : Only the means and standard deviations of the negative head are kept and returned
         # Using cuda (GPU) if available
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print (f'Using device: {device}')
         network = self.to(device)
-        network.load_state_dict(torch.load(weight_file))# Load weights from the .pt file
+        network.load_weights(weight_file) # Load weights from the .pt file
         network.eval() # Set the network in evalution mode
+        forward = compile_function(network.forward if heads == 'both' else network.negative_forward, self.settings)
+
+        # The rows are encoded in chunks, every layer runs as a single matrix multiplication per chunk
+        # The chunk size is bounded by the memory of the activations of a row (4 bytes per input feature and per output of every layer)
+        row_bytes = 4 * (self.input_size + sum(layer.out_features for layer in self.modules() if isinstance(layer, torch.nn.Linear)))
+        chunk = chunk_rows(self.settings, row_bytes)
+
+        # The outputs of every chunk are written into preallocated (N x n_latent) tensors
+        n = len(test_data)
+        final_negative_mean = torch.empty((n, self.n_latent))
+        final_negative_var = torch.empty((n, self.n_latent))
+        if heads == 'both':
+            final_positive_mean = torch.empty((n, self.n_latent))
+            final_positive_var = torch.empty((n, self.n_latent))
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
+        for start in range(0, n, chunk):
+            input = test_data[start:start+chunk].to(device)
+            with torch.inference_mode(), autocast(self.settings):
+                if heads == 'both':
+                    positive_mean, positive_logvariance, negative_mean, negative_logvariance = forward(input)
+                    final_positive_mean[start:start+chunk] = positive_mean.float()
+                    final_positive_var[start:start+chunk] = torch.exp(positive_logvariance.float()/2)
+                else:
+                    negative_mean, negative_logvariance = forward(input)
+                final_negative_mean[start:start+chunk] = negative_mean.float()
+                final_negative_var[start:start+chunk] = torch.exp(negative_logvariance.float()/2)
+            profiler.step()
+        profiler.stop()
 
-        final_input = []
-        final_positive_mean = []
-        final_negative_mean = []
-        final_positive_var = []
-        final_negative_var = []
-        final_class = []
-        for i in range(len(test_data)):
-            input = test_data[i]
-            class_name = labels[i]
-            final_input.append(input)
-            final_class.append(int(class_name))
-            input = input.to(device)
-            with torch.no_grad():
-                positive_mean, positive_logvariance, negative_mean, negative_logvariance = network.forward(input)
-                final_positive_mean.append(positive_mean)
-                final_positive_var.append(torch.exp(positive_logvariance/2))
-                final_negative_mean.append(negative_mean)
-                final_negative_var.append(torch.exp(negative_logvariance/2))
-        
         result = dict()
-        result['final_input'] = final_input
-        result['final_class'] = final_class
-        result['final_positive_mean'] = final_positive_mean
-        result['final_positive_var'] = final_positive_var
+        result['final_input'] = test_data
+        result['final_class'] = [int(class_name) for class_name in labels.tolist()]
+        if heads == 'both':
+            result['final_positive_mean'] = final_positive_mean
+            result['final_positive_var'] = final_positive_var
         result['final_negative_mean'] = final_negative_mean
         result['final_negative_var'] = final_negative_var
 
@@ -1,5 +1,30 @@
 from typing import Tuple
 import torch
+import os
+import sys
+
+from DCSAE.DC_SAE import fuse_latent_heads
+from DCSAE.DC_SAE import latent_separation
+from DCSAE.DC_SAE import separation_subset
+from utils.checkpoint import CheckpointWriter
+from utils.checkpoint import TerminationHandler
+from utils.checkpoint import restore_training_state
+from utils.checkpoint import training_state
+from utils.checkpoint import training_state_path
+from utils.distributed import all_reduce_sum
+from utils.distributed import broadcast_flag
+from utils.distributed import distribute
+from utils.distributed import is_main_process
+from utils.distributed import shard
+from utils.distributed import shard_permutation
+from utils.metrics import MetricsAggregator
+from utils.metrics import metrics_path
+from utils.runtime import autocast
+from utils.runtime import compile_function
+from utils.timing import PhaseTimer
+from utils.timing import timing_path
+from utils.memory import MemoryStage
+from utils.profiling import StepProfiler
 
 class NumDCSAE(torch.nn.Module):
     def __init__(self,
@@ -10,6 +35,7 @@ class NumDCSAE(torch.nn.Module):
                  rho: float,
                  input_size: int,
                  batch: int = 1, 
+                 settings: dict = None,
                  ) -> None:
         super(NumDCSAE, self).__init__()
         # Initializing the class variables
@@ -19,6 +45,7 @@ class NumDCSAE(torch.nn.Module):
         self.gamma = gamma
         self.rho = rho
         self.batch = batch
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
         self.input_size = input_size
 
         # Early Stopping
@@ -26,6 +53,8 @@ class NumDCSAE(torch.nn.Module):
         self.delta = 1e-4
         self.best_score = None
         self.num_bad_epochs = 0
+        self.best_separation = None
+        self.num_bad_separation_epochs = 0
 
         # Dense Encoder Bottleneck
         self.enc_dense1 = torch.nn.Linear(self.input_size, 2048)
@@ -38,17 +67,10 @@ class NumDCSAE(torch.nn.Module):
         self.enc_dense3_af = torch.nn.LeakyReLU(0.1)
 
         # Latent Variables Calculation
-        self.enc_dense4_mu_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_mu_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_mu_negative_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_positive = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_positive_af = torch.nn.LeakyReLU(0.1)
-
-        self.enc_dense4_var_negative = torch.nn.Linear(250, self.n_latent)
-        self.enc_dense4_var_negative_af = torch.nn.LeakyReLU(0.1)
+        # The means and log-variances of both heads are computed by a single layer whose output is laid out as
+        # [mu_positive | mu_negative | var_positive | var_negative]
+        self.enc_dense4 = torch.nn.Linear(250, 4 * self.n_latent)
+        self.enc_dense4_af = torch.nn.LeakyReLU(0.1)
 
         # Dense Decoder Bottleneck
         self.dec_dense4 = torch.nn.Linear(self.n_latent, 250)
@@ -76,23 +98,39 @@ class NumDCSAE(torch.nn.Module):
 
         return z
     
-    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_positive(z)
-        mu = self.enc_dense4_mu_positive_af(mu)
+    def latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        latent = self.enc_dense4(z)
+        latent = self.enc_dense4_af(latent)
 
-        var = self.enc_dense4_var_positive(z)
-        var = self.enc_dense4_var_positive_af(var)
+        # Splitting the fused output into views of (mu_positive, mu_negative, var_positive, var_negative)
+        # Explicit slices are used instead of chunk() because the backward of chunk() is miscompiled by torch.compile on CPU
+        n = self.n_latent
+        return latent[..., :n], latent[..., n:2*n], latent[..., 2*n:3*n], latent[..., 3*n:]
 
+    def positive_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
+        mu, _, var, _ = self.latent_calc(z)
         return mu, var
     
     def negative_latent_calc(self, z: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu = self.enc_dense4_mu_negative(z)
-        mu = self.enc_dense4_mu_negative_af(mu)
-
-        var = self.enc_dense4_var_negative(z)
-        var = self.enc_dense4_var_negative_af(var)
-
+        _, mu, _, var = self.latent_calc(z)
         return mu, var
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # Checkpoints saved with four separate latent layers are converted to the fused layer transparently
+        return super(NumDCSAE, self).load_state_dict(fuse_latent_heads(state_dict), *args, **kwargs)
+    
+    def class_latent_calc(self, z: torch.Tensor, class_name: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Selecting the latent head of each sample in the batch on the basis of its class (0 : Negative, 1 : Positive)
+        # The head of the sample's own class is the "current" head and the head of the opposite class is the "other" head
+        positive_mu, negative_mu, positive_var, negative_var = self.latent_calc(z)
+        mask = (torch.as_tensor(class_name, device=z.device) == 1).unsqueeze(-1)
+
+        current_mu = torch.where(mask, positive_mu, negative_mu)
+        current_var = torch.where(mask, positive_var, negative_var)
+        other_mu = torch.where(mask, negative_mu, positive_mu)
+        other_var = torch.where(mask, negative_var, positive_var)
+
+        return current_mu, current_var, other_mu, other_var
     
     def decode(self, z: torch.Tensor) -> torch.Tensor:
         # Dense Decoder Bottleneck
@@ -110,13 +148,10 @@ class NumDCSAE(torch.nn.Module):
 
         return y
     
-    def forward(self, x: torch.Tensor, class_name: int) -> Tuple[torch.Tensor]:
+    def forward(self, x: torch.Tensor, class_name: torch.Tensor) -> Tuple[torch.Tensor]:
+        # The encoder trunk is run once and shared by both latent heads
         z = self.encode(x)
-
-        if class_name==0:
-            mu, logvar = self.negative_latent_calc(z)
-        else:
-            mu, logvar = self.positive_latent_calc(z)
+        mu, logvar, other_mu, other_logvar = self.class_latent_calc(z, class_name)
 
         std = torch.exp(logvar / 2)
         eps = torch.randn_like(std)
@@ -124,7 +159,31 @@ class NumDCSAE(torch.nn.Module):
 
         out = self.decode(z)
 
-        return out, mu, logvar
+        return out, mu, logvar, other_mu, other_logvar
+    
+    def loss_calc(self,
+                  input: torch.Tensor,
+                  out: torch.Tensor,
+                  current_mu: torch.Tensor,
+                  current_logvar: torch.Tensor,
+                  other_mu: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Every loss term is computed per sample in float32 and then averaged over the batch
+        out, current_mu, current_logvar, other_mu = out.float(), current_mu.float(), current_logvar.float(), other_mu.float()
+
+        # KL-Divergence Loss (Regularization loss in VAE Loss function)
+        kl_loss = torch.mul(input=torch.sum(current_mu.pow(2) + current_logvar.exp() - current_logvar - 1, dim=-1), other=0.5)
+
+        # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
+        mse_loss = torch.nn.functional.mse_loss(out, input, reduction='none').mean(dim=-1)
+
+        # Repulsion Loss (For increasing the distance between the clusters belonging to positive and negative classes)
+        distance = torch.sqrt(torch.sum(torch.square(current_mu-other_mu), dim=-1))
+        repulsion_loss = torch.clamp(self.rho-distance, min=0)**2/self.rho
+
+        # Total Loss =  (Alpha * Regularization Loss + Beta * Reconstruction Loss + Gamma * Repulsion Loss)/(Alpha + Beta + Gamma)
+        loss = (torch.mul(kl_loss, self.alpha) + torch.mul(mse_loss, self.beta) + torch.mul(repulsion_loss, self.gamma)) / (self.alpha + self.beta + self.gamma)
+
+        return loss.mean(), kl_loss.mean(), mse_loss.mean(), repulsion_loss.mean()
     
     def testing(self,
                 test_data: torch.Tensor,
@@ -136,50 +195,89 @@ class NumDCSAE(torch.nn.Module):
         network = self.to(device)
         network.load_state_dict(torch.load(weight_file)) # Load weights from the .pt file
         network.eval() # Set the network in evalution mode
+        forward = compile_function(network.forward, self.settings)
 
-        final_input = []
-        final_class = []
         final_output = []
         final_positive_mean = []
         final_negative_mean = []
         final_positive_var = []
         final_negative_var = []
-        for i in range(len(test_data)):
-            input = test_data[i]
-            class_name = int(labels[i])
-            final_input.append(input)
-            final_class.append(int(class_name))
-            input = input.to(device)
-            with torch.no_grad():
-                output, current_mean, current_logvariance = network.forward(input, int(class_name))
-                other_output, other_mean, other_logvariance = network.forward(input, abs(int(class_name)-1))
-                final_positive_mean.append(current_mean)
-                final_positive_var.append(torch.exp(current_logvariance/2))
-                final_negative_mean.append(other_mean)
-                final_negative_var.append(torch.exp(other_logvariance/2))
-                final_output.append(output)
-
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
+        for start in range(0, len(test_data), self.batch):
+            input = test_data[start:start+self.batch].to(device)
+            class_name = labels[start:start+self.batch].to(device)
+            with torch.no_grad(), autocast(self.settings):
+                output, current_mean, current_logvariance, other_mean, other_logvariance = forward(input, class_name)
+                final_positive_mean.append(current_mean.float())
+                final_positive_var.append(torch.exp(current_logvariance.float()/2))
+                final_negative_mean.append(other_mean.float())
+                final_negative_var.append(torch.exp(other_logvariance.float()/2))
+                final_output.append(output.float())
+            profiler.step()
+        profiler.stop()
+
+        # Stacking the per-batch outputs into (N x n_latent) tensors
         result = dict()
-        result['final_input'] = final_input
-        result['final_class'] = final_class
-        result['final_output'] = final_output
-        result['final_positive_mean'] = final_positive_mean
-        result['final_positive_var'] = final_positive_var
-        result['final_negative_mean'] = final_negative_mean
-        result['final_negative_var'] = final_negative_var
+        result['final_input'] = test_data
+        result['final_class'] = [int(class_name) for class_name in labels.tolist()]
+        result['final_output'] = torch.cat(final_output)
+        result['final_positive_mean'] = torch.cat(final_positive_mean)
+        result['final_positive_var'] = torch.cat(final_positive_var)
+        result['final_negative_mean'] = torch.cat(final_negative_mean)
+        result['final_negative_var'] = torch.cat(final_negative_var)
         return result
     
+    def validate(self, forward, val_data: torch.Tensor, val_labels: torch.Tensor, slots: torch.Tensor = None) -> Tuple[float]:
+        # Sum of the per-sample reconstruction losses over the validation dataset
+        # Only Linear layers and activations, so eval() does not change the output, what matters is that no autograd graph is built
+        # Optionally, the latent separation of the classes is measured on the validation samples selected by separation_subset()
+        self.eval()
+        val_loss = torch.zeros((), device=val_data.device)
+        metric = self.settings.get("separation_metric", "none")
+        measure = metric != "none" and slots is not None and bool((slots >= 0).any())
+        if measure:
+            positions = shard(slots.to(val_data.device)) # Slots of the rows of this process, in the same order as val_data
+            subset = torch.zeros((int((slots >= 0).sum()), 2 * self.n_latent + 1), device=val_data.device) # mu, other_mu and class of every sample of the subset
+        with torch.inference_mode(), autocast(self.settings):
+            for start in range(0, len(val_data), self.batch):
+                input = val_data[start:start+self.batch]
+                class_name = val_labels[start:start+self.batch]
+                output, mu, logvar, other_mu, other_logvar = forward(input, class_name)
+                val_loss += torch.nn.functional.mse_loss(output.float(), input) * input.size(0)
+                if measure:
+                    slot = positions[start:start+self.batch]
+                    keep = slot >= 0
+                    subset[slot[keep]] = torch.cat([mu.float(), other_mu.float(), class_name.float().unsqueeze(-1)], dim=-1)[keep]
+        self.train()
+
+        separation = None
+        if measure:
+            subset = all_reduce_sum(subset) # Every sample of the subset is read by exactly one process
+            mu, other_mu, class_name = subset.split([self.n_latent, self.n_latent, 1], dim=-1)
+            separation = float(latent_separation(mu, other_mu, class_name.squeeze(-1).long(), self.rho, metric))
+        return float(all_reduce_sum(val_loss)), separation # Single synchronization with the device (and the other processes) per validation pass
+
+    def check_separation(self, curr_score) -> bool:
+        # Same plateau rule as check() for the latent separation, which is better when it is higher
+        if self.best_separation==None or curr_score-self.best_separation>self.delta:
+            self.best_separation = curr_score
+            self.num_bad_separation_epochs = 0
+        else:
+            self.num_bad_separation_epochs += 1
+        return self.num_bad_separation_epochs==(self.settings.get("separation_patience") or self.patience)
+
     def check(self, curr_score, model, weights_file) :
         if self.best_score==None:
             self.best_score = curr_score
             state_dict = model.state_dict()
-            torch.save(state_dict, weights_file)
+            self.checkpoint_writer.submit(state_dict, weights_file)
         else:
             if self.best_score-curr_score>self.delta:
                 self.best_score = curr_score
                 self.num_bad_epochs = 0
                 state_dict = model.state_dict()
-                torch.save(state_dict, weights_file)
+                self.checkpoint_writer.submit(state_dict, weights_file)
             else:
                 self.num_bad_epochs += 1
         if self.num_bad_epochs==self.patience:
@@ -211,53 +309,112 @@ class NumDCSAE(torch.nn.Module):
         hyperparameters["beta"] = self.beta
         hyperparameters["gamma"] = self.gamma
         hyperparameters["rho"] = self.rho
-        torch.save(hyperparameters, hyperparameters_file)
+        hyperparameters["precision"] = self.settings.get("precision", "fp32")
+        if is_main_process():
+            torch.save(hyperparameters, hyperparameters_file)
 
         # Using Adam Optimizer for training
         optimizer = torch.optim.Adam(network.parameters(), lr=learning_rate)
 
-        for epoch in range(epochs):
-            epoch_loss = 0
-            for i in range(len(train_data)):
-                input = train_data[i]
-                input = input.to(device)
-                class_name = int(train_labels[i])
+        # The best weights found by early stopping are written to disk in the background
+        self.checkpoint_writer = CheckpointWriter()
 
-                # Passing the input image through VAE Network
-                out, current_mu, current_logvar = network.forward(input, int(class_name))
-
-                if int(class_name)==1:
-                    other_mu, other_logvar = network.negative_latent_calc(network.encode(input))
-                else:
-                    other_mu, other_logvar = network.positive_latent_calc(network.encode(input))
-
-                # KL-Divergence Loss (Regularization loss in VAE Loss function)
-                kl_loss = torch.mul(input=torch.sum(current_mu.pow(2) + current_logvar.exp() - current_logvar - 1), other=0.5)
-
-                # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
-                mse_loss = torch.nn.functional.mse_loss(out, input)
-
-                # Repulsion Loss (For increasing the distance between the clusters belonging to positive and negative classes)
-                repulsion_loss = max(0, self.rho-torch.sqrt(torch.sum(torch.square(current_mu-other_mu))))**2/self.rho
-
-                # Total Loss =  (Alpha * Regularization Loss + Beta * Reconstruction Loss + Gamma * Repulsion Loss)/(Alpha + Beta + Gamma)
-                loss = (torch.mul(kl_loss, self.alpha) + torch.mul(mse_loss, self.beta) + torch.mul(repulsion_loss, self.gamma)) / (self.alpha + self.beta + self.gamma)
+        # Continuing an interrupted run from its last full training state
+        state_file = training_state_path(weights_file)
+        start_epoch = 0
+        if self.settings.get("resume", False):
+            if os.path.exists(state_file):
+                start_epoch = restore_training_state(state_file, network, optimizer)
+                print(f'Resuming training from epoch {start_epoch} using {state_file}')
+            else:
+                print(f'No training state found at {state_file}, training from scratch')
+        checkpoint_every = self.settings.get("checkpoint_every", 1) # Epochs between two full training state checkpoints
+        termination = TerminationHandler()
+
+        # Per-epoch means of the loss components, printed and written next to the weights
+        metrics = MetricsAggregator(metrics_path(weights_file), append=start_epoch > 0)
+
+        # The whole dataset is moved to the device once, mini-batches are sliced from it directly
+        train_data = train_data.to(device)
+        train_labels = train_labels.to(device)
+        val_data = val_data.to(device)
+        val_labels = val_labels.to(device)
+
+        # Validation samples on which the latent separation is measured
+        slots = None
+        if self.settings.get("separation_metric", "none") != "none":
+            slots = separation_subset(val_labels, self.settings.get("separation_samples", 512))
+
+        # In data-parallel training the network is wrapped with DistributedDataParallel, which averages the gradients across the processes
+        model = distribute(network)
+
+        # A single training step (forward pass and loss), compiled as a whole with torch.compile when enabled
+        def train_step(input, class_name):
+            with autocast(self.settings):
+                out, current_mu, current_logvar, other_mu, other_logvar = model(input, class_name)
+            return network.loss_calc(input, out, current_mu, current_logvar, other_mu)
+        train_step = compile_function(train_step, self.settings)
+        forward = compile_function(network.forward, self.settings)
+        # Wall-clock time of every phase of training, written next to the weights
+        timer = PhaseTimer(device, timing_path(weights_file), append=start_epoch > 0, compiled=self.settings.get("compile", False))
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_train')
+        profiler.start()
+
+        for epoch in range(start_epoch, epochs):
+            memory = MemoryStage(self.settings, 'train_epoch', epoch=epoch)
+            memory.start()
+            timer.start_epoch()
+            permutation = shard_permutation(len(train_data), epoch, device) # Shuffling the training dataset every epoch (and sharding it in data-parallel training)
+            for start in range(0, len(permutation), self.batch):
+                indices = permutation[start:start+self.batch]
+                input = train_data[indices]
+                class_name = train_labels[indices]
+                timer.lap('data')
+
+                # Passing the input batch through VAE Network
+                loss, kl_loss, mse_loss, repulsion_loss = train_step(input, class_name)
+                timer.lap('forward')
 
                 optimizer.zero_grad() # Sets gradients of all model parameters to zero
                 loss.backward() # Perform Back-Propogation
+                timer.lap('backward')
                 optimizer.step() # Performs a single optimization step (parameter update)
-                epoch_loss += loss
-
-            val_loss = 0
-            for i in range(len(val_data)):
-                input = val_data[i]
-                input = input.to(device)
-                class_name = int(val_labels[i])
-                output, mu, logvar = network.forward(input, int(class_name))
-                mse_val_loss = torch.nn.functional.mse_loss(output, input)
-                val_loss += mse_val_loss
-            if self.check(val_loss, network, weights_file):
+                timer.lap('optimizer')
+                profiler.step()
+                metrics.update(input.size(0), loss, KL=kl_loss, MSE=mse_loss, Repulsion=repulsion_loss)
+
+                # On SIGTERM the current state is saved and the interrupted epoch is run again when resuming
+                if termination.poll():
+                    if is_main_process():
+                        self.checkpoint_writer.submit(training_state(epoch, network, optimizer), state_file)
+                    self.checkpoint_writer.close()
+                    print(f'Training interrupted at epoch {epoch}, the training state was saved to {state_file}')
+                    sys.exit(143)
+                timer.lap('bookkeeping') # Metrics, profiler and SIGTERM poll of the step
+                timer.end_step(input.size(0))
+
+            val_loss, separation = self.validate(forward, shard(val_data), shard(val_labels), slots)
+            metrics.emit(epoch, val_loss, separation)
+            timer.lap('validation')
+            # Rank 0 decides on early stopping and writes the checkpoints, the other processes follow its decision
+            # When the latent separation is measured, training stops as soon as either the validation loss or the separation stops improving
+            stop = False
+            if is_main_process():
+                stop = self.check(val_loss, network, weights_file)
+                if separation is not None:
+                    stop = self.check_separation(separation) or stop
+            stop = broadcast_flag(stop)
+            if not stop and checkpoint_every > 0 and (epoch + 1) % checkpoint_every == 0 and is_main_process():
+                self.checkpoint_writer.submit(training_state(epoch + 1, network, optimizer), state_file)
+            timer.lap('checkpoint')
+            timer.end_epoch(epoch, epochs)
+            memory.stop(timer.samples)
+            if stop:
                 print(f'Early Stopping at epoch {epoch}')
                 break
-            print(f'Epoch: {epoch}; Training Loss: {epoch_loss}; Validation Loss: {val_loss}')
+        profiler.stop()
+        if is_main_process():
+            timer.report()
+        self.checkpoint_writer.close() # Waits until the best weights are on disk
+        termination.restore()
         print('Training finished, saving weights...')
\ No newline at end of file
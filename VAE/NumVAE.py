@@ -1,18 +1,42 @@
 from typing import Tuple
 import torch
+import os
+import sys
+
+from utils.checkpoint import CheckpointWriter
+from utils.checkpoint import TerminationHandler
+from utils.checkpoint import restore_training_state
+from utils.checkpoint import training_state
+from utils.checkpoint import training_state_path
+from utils.distributed import all_reduce_sum
+from utils.distributed import broadcast_flag
+from utils.distributed import distribute
+from utils.distributed import is_main_process
+from utils.distributed import shard
+from utils.distributed import shard_permutation
+from utils.metrics import MetricsAggregator
+from utils.metrics import metrics_path
+from utils.runtime import autocast
+from utils.runtime import compile_function
+from utils.timing import PhaseTimer
+from utils.timing import timing_path
+from utils.memory import MemoryStage
+from utils.profiling import StepProfiler
 
 class NumStandardVAE(torch.nn.Module):
     def __init__(self,
                  n_latent: int,
                  beta: float,
                  input_size: int,
-                 batch: int = 1) -> None:
+                 batch: int = 1,
+                 settings: dict = None) -> None:
         super(NumStandardVAE, self).__init__()
         # Initializing the class variables
         self.n_latent = n_latent
         self.beta = beta
         self.input_size = input_size
         self.batch = batch
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
 
         # Early Stopping
         self.patience = 10
@@ -94,6 +118,25 @@ class NumStandardVAE(torch.nn.Module):
         out = self.decode(z)
         return out, mu, logvar
     
+    def loss_calc(self,
+                  input: torch.Tensor,
+                  out: torch.Tensor,
+                  mu: torch.Tensor,
+                  logvar: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Every loss term is computed per sample in float32 and then averaged over the batch
+        out, mu, logvar = out.float(), mu.float(), logvar.float()
+
+        # KL-Divergence Loss (Regularization loss in VAE Loss function)
+        kl_loss = torch.mul(input=torch.sum(mu.pow(2) + logvar.exp() - logvar - 1, dim=-1), other=0.5)
+
+        # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
+        mse_loss = torch.nn.functional.mse_loss(out, input, reduction='none').mean(dim=-1)
+
+        # Total Loss = Regularization Loss + Beta * Reconstruction Loss
+        loss = kl_loss + torch.mul(mse_loss, self.beta)
+
+        return loss.mean(), kl_loss.mean(), mse_loss.mean()
+    
     def testing(self,
                 test_data: torch.Tensor,
                 labels: torch.Tensor,
@@ -104,43 +147,57 @@ class NumStandardVAE(torch.nn.Module):
         network = self.to(device)
         network.load_state_dict(torch.load(weight_file)) # Load weights from the .pt file
         network.eval() # Set the network in evalution mode       
+        forward = compile_function(network.forward, self.settings)
 
-        final_input = []
-        final_class = []
         final_output = []
         final_mean = []
         final_var = []
-        for i in range(len(test_data)):
-            input = test_data[i]
-            class_name = int(labels[i])
-            final_input.append(input)
-            final_class.append(int(class_name))
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
+        for start in range(0, len(test_data), self.batch):
+            input = test_data[start:start+self.batch]
             input = input.to(device)
-            with torch.no_grad():
-                output, mean, logvariance = network.forward(input)
-                final_mean.append(mean)
-                final_var.append(torch.exp(logvariance/2))
-                final_output.append(output)
-
+            with torch.no_grad(), autocast(self.settings):
+                output, mean, logvariance = forward(input)
+                final_mean.append(mean.float())
+                final_var.append(torch.exp(logvariance.float()/2))
+                final_output.append(output.float())
+            profiler.step()
+        profiler.stop()
+
+        # Stacking the per-batch outputs into (N x n_latent) tensors
         result = dict()
-        result['final_input'] = final_input
-        result['final_class'] = final_class
-        result['final_output'] = final_output
-        result['final_mean'] = final_mean
-        result['final_var'] = final_var
+        result['final_input'] = test_data
+        result['final_class'] = [int(class_name) for class_name in labels.tolist()]
+        result['final_output'] = torch.cat(final_output)
+        result['final_mean'] = torch.cat(final_mean)
+        result['final_var'] = torch.cat(final_var)
         return result
     
+    def validate(self, forward, val_data: torch.Tensor) -> float:
+        # Sum of the per-sample reconstruction losses over the validation dataset
+        # No layer of the tabular VAE behaves differently in evaluation mode, the validation pass only saves the autograd bookkeeping
+        self.eval()
+        val_loss = torch.zeros((), device=val_data.device)
+        with torch.inference_mode(), autocast(self.settings):
+            for start in range(0, len(val_data), self.batch):
+                input = val_data[start:start+self.batch]
+                output, mu, logvar = forward(input)
+                val_loss += torch.nn.functional.mse_loss(output.float(), input) * input.size(0)
+        self.train()
+        return float(all_reduce_sum(val_loss)) # Single synchronization with the device (and the other processes) per validation pass
+
     def check(self, curr_score, model, weights_file) :
         if self.best_score==None:
             self.best_score = curr_score
             state_dict = model.state_dict()
-            torch.save(state_dict, weights_file)
+            self.checkpoint_writer.submit(state_dict, weights_file)
         else:
             if self.best_score-curr_score>self.delta:
                 self.best_score = curr_score
                 self.num_bad_epochs = 0
                 state_dict = model.state_dict()
-                torch.save(state_dict, weights_file)
+                self.checkpoint_writer.submit(state_dict, weights_file)
             else:
                 self.num_bad_epochs += 1
         if self.num_bad_epochs==self.patience:
@@ -167,43 +224,98 @@ class NumStandardVAE(torch.nn.Module):
         hyperparameters = {}
         hyperparameters["n_latent"] = self.n_latent
         hyperparameters["beta"] = self.beta
-        torch.save(hyperparameters, hyperparameters_file)
+        hyperparameters["precision"] = self.settings.get("precision", "fp32")
+        if is_main_process():
+            torch.save(hyperparameters, hyperparameters_file)
 
         # Using Adam Optimizer for training
         optimizer = torch.optim.Adam(network.parameters(), lr=learning_rate)
 
-        for epoch in range(epochs):
-            epoch_loss = 0
-            for i in range(len(train_data)):
-                input = train_data[i]
-                input = input.to(device)
-
-                # Passing the input image through VAE Network
-                out, mu, logvar = network.forward(input)
-
-                # KL-Divergence Loss (Regularization loss in VAE Loss function)
-                kl_loss = torch.mul(input=torch.sum(mu.pow(2) + logvar.exp() - logvar - 1), other=0.5)
+        # The best weights found by early stopping are written to disk in the background
+        self.checkpoint_writer = CheckpointWriter()
 
-                # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
-                mse_loss = torch.nn.functional.mse_loss(out, input)
-
-                # Total Loss = Regularization Loss + Beta * Reconstruction Loss
-                loss = kl_loss + torch.mul(mse_loss, self.beta)
+        # Continuing an interrupted run from its last full training state
+        state_file = training_state_path(weights_file)
+        start_epoch = 0
+        if self.settings.get("resume", False):
+            if os.path.exists(state_file):
+                start_epoch = restore_training_state(state_file, network, optimizer)
+                print(f'Resuming training from epoch {start_epoch} using {state_file}')
+            else:
+                print(f'No training state found at {state_file}, training from scratch')
+        checkpoint_every = self.settings.get("checkpoint_every", 1) # Epochs between two full training state checkpoints
+        termination = TerminationHandler()
+
+        # Per-epoch means of the loss components, printed and written next to the weights
+        metrics = MetricsAggregator(metrics_path(weights_file), append=start_epoch > 0)
+
+        # The whole dataset is moved to the device once, mini-batches are sliced from it directly
+        train_data = train_data.to(device)
+        val_data = val_data.to(device)
+
+        # In data-parallel training the network is wrapped with DistributedDataParallel, which averages the gradients across the processes
+        model = distribute(network)
+
+        # A single training step (forward pass and loss), compiled as a whole with torch.compile when enabled
+        def train_step(input):
+            with autocast(self.settings):
+                out, mu, logvar = model(input)
+            return network.loss_calc(input, out, mu, logvar)
+        train_step = compile_function(train_step, self.settings)
+        forward = compile_function(network.forward, self.settings)
+        # Wall-clock time of every phase of training, written next to the weights
+        timer = PhaseTimer(device, timing_path(weights_file), append=start_epoch > 0, compiled=self.settings.get("compile", False))
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_train')
+        profiler.start()
+
+        for epoch in range(start_epoch, epochs):
+            memory = MemoryStage(self.settings, 'train_epoch', epoch=epoch)
+            memory.start()
+            timer.start_epoch()
+            permutation = shard_permutation(len(train_data), epoch, device) # Shuffling the training dataset every epoch (and sharding it in data-parallel training)
+            for start in range(0, len(permutation), self.batch):
+                input = train_data[permutation[start:start+self.batch]]
+                timer.lap('data')
+
+                # Passing the input batch through VAE Network
+                loss, kl_loss, mse_loss = train_step(input)
+                timer.lap('forward')
 
                 optimizer.zero_grad() # Sets gradients of all model parameters to zero
                 loss.backward() # Perform Back-Propogation
+                timer.lap('backward')
                 optimizer.step() # Performs a single optimization step (parameter update)
-                epoch_loss += loss
-
-            val_loss = 0
-            for i in range(len(val_data)):
-                input = val_data[i]
-                input = input.to(device)
-                output, mu, logvar = network.forward(input)
-                mse_val_loss = torch.nn.functional.mse_loss(output, input)
-                val_loss += mse_val_loss
-            if self.check(val_loss, network, weights_file):
+                timer.lap('optimizer')
+                profiler.step()
+                metrics.update(input.size(0), loss, KL=kl_loss, MSE=mse_loss)
+
+                # On SIGTERM the current state is saved and the interrupted epoch is run again when resuming
+                if termination.poll():
+                    if is_main_process():
+                        self.checkpoint_writer.submit(training_state(epoch, network, optimizer), state_file)
+                    self.checkpoint_writer.close()
+                    print(f'Training interrupted at epoch {epoch}, the training state was saved to {state_file}')
+                    sys.exit(143)
+                timer.lap('bookkeeping') # Metrics, profiler and SIGTERM poll of the step
+                timer.end_step(input.size(0))
+
+            val_loss = self.validate(forward, shard(val_data))
+            metrics.emit(epoch, val_loss)
+            timer.lap('validation')
+            # Rank 0 decides on early stopping and writes the checkpoints, the other processes follow its decision
+            stop = self.check(val_loss, network, weights_file) if is_main_process() else False
+            stop = broadcast_flag(stop)
+            if not stop and checkpoint_every > 0 and (epoch + 1) % checkpoint_every == 0 and is_main_process():
+                self.checkpoint_writer.submit(training_state(epoch + 1, network, optimizer), state_file)
+            timer.lap('checkpoint')
+            timer.end_epoch(epoch, epochs)
+            memory.stop(timer.samples)
+            if stop:
                 print(f'Early Stopping at epoch {epoch}')
                 break
-            print(f'Epoch: {epoch}; Training Loss: {epoch_loss}; Validation Loss: {val_loss}')
+        profiler.stop()
+        if is_main_process():
+            timer.report()
+        self.checkpoint_writer.close() # Waits until the best weights are on disk
+        termination.restore()
         print('Training finished, saving weights...')
\ No newline at end of file
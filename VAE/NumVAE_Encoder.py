@@ -1,13 +1,20 @@
 import torch
 
+from utils.runtime import autocast
+from utils.runtime import chunk_rows
+from utils.runtime import compile_function
+from utils.profiling import StepProfiler
+
 class NumVAE_Encoder(torch.nn.Module):
     def __init__(self,
                  n_latent: int,
-                 input_size: int) -> None:
+                 input_size: int,
+                 settings: dict = None) -> None:
         super(NumVAE_Encoder, self).__init__()
         # Initializing the class variables
         self.n_latent = n_latent
         self.input_size = input_size
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
 
         # Dense Encoder Bottleneck
         self.enc_dense1 = torch.nn.Linear(self.input_size, 2048)
@@ -55,25 +62,31 @@ class NumVAE_Encoder(torch.nn.Module):
         network = self.to(device)
         network.load_state_dict(torch.load(weight_file))# Load weights from the .pt file
         network.eval() # Set the network in evalution mode
+        encode = compile_function(network.encode, self.settings)
+
+        # The rows are encoded in chunks, every layer runs as a single matrix multiplication per chunk
+        # The chunk size is bounded by the memory of the activations of a row (4 bytes per input feature and per output of every layer)
+        row_bytes = 4 * (self.input_size + sum(layer.out_features for layer in self.modules() if isinstance(layer, torch.nn.Linear)))
+        chunk = chunk_rows(self.settings, row_bytes)
+
+        # The outputs of every chunk are written into preallocated (N x n_latent) tensors
+        n = len(test_data)
+        final_mean = torch.empty((n, self.n_latent))
+        final_var = torch.empty((n, self.n_latent))
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
+        for start in range(0, n, chunk):
+            input = test_data[start:start+chunk].to(device)
+            with torch.inference_mode(), autocast(self.settings):
+                mu, logvar = encode(input)
+                final_mean[start:start+chunk] = mu.float()
+                final_var[start:start+chunk] = torch.exp(logvar.float()/2)
+            profiler.step()
+        profiler.stop()
 
-        final_input = []
-        final_mean = []
-        final_var = []
-        final_class = []
-        for i in range(len(test_data)):
-            input = test_data[i]
-            class_name = labels[i]
-            final_input.append(input)
-            final_class.append(int(class_name))
-            input = input.to(device)
-            with torch.no_grad():
-                mu, logvar = network.encode(input)
-                final_mean.append(mu)
-                final_var.append(torch.exp(logvar/2))
-        
         result = dict()
-        result['final_input'] = final_input
-        result['final_class'] = final_class
+        result['final_input'] = test_data
+        result['final_class'] = [int(class_name) for class_name in labels.tolist()]
         result['final_mean'] = final_mean
         result['final_var'] = final_var
 
@@ -1,20 +1,46 @@
 from typing import Tuple
 import torch
+import os
+import sys
 import torchvision
 import math
 
+from utils.data import load_image_folder
+from utils.data import make_loader
+from utils.checkpoint import CheckpointWriter
+from utils.checkpoint import TerminationHandler
+from utils.checkpoint import restore_training_state
+from utils.checkpoint import training_state
+from utils.checkpoint import training_state_path
+from utils.distributed import all_reduce_sum
+from utils.distributed import broadcast_flag
+from utils.distributed import distribute
+from utils.distributed import is_main_process
+from utils.distributed import set_epoch
+from utils.metrics import MetricsAggregator
+from utils.metrics import metrics_path
+from utils.runtime import autocast
+from utils.runtime import compile_function
+from utils.runtime import memory_format
+from utils.timing import PhaseTimer
+from utils.timing import timing_path
+from utils.memory import MemoryStage
+from utils.profiling import StepProfiler
+
 class StandardVAE(torch.nn.Module):
     def __init__(self,
                  n_latent: int,
                  beta: float,
                  n_chan: int,
                  input_d: Tuple[int],
-                 batch: int = 1) -> None:
+                 batch: int = 1,
+                 settings: dict = None) -> None:
         super(StandardVAE, self).__init__()
         # Initializing the class variables
         self.n_latent = n_latent
         self.beta = beta
         self.batch = batch
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
         self.n_chan = n_chan
         self.input_d = input_d
 
@@ -164,29 +190,30 @@ class StandardVAE(torch.nn.Module):
 
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         # Convolutional Encoder Network
+        # The input of every BatchNorm layer is cast to float32 so that it never runs in bfloat16 under autocast
         z = x
         z = self.enc_conv1(z)
-        z = self.enc_conv1_bn(z)
+        z = self.enc_conv1_bn(z.float())
         z = self.enc_conv1_af(z)
-        z, self.indices1 = self.enc_conv1_pool(z)
+        z, indices1 = self.enc_conv1_pool(z)
 
         z = self.enc_conv2(z)
-        z = self.enc_conv2_bn(z)
+        z = self.enc_conv2_bn(z.float())
         z = self.enc_conv2_af(z)
-        z, self.indices2 = self.enc_conv2_pool(z)
+        z, indices2 = self.enc_conv2_pool(z)
 
         z = self.enc_conv3(z)
-        z = self.enc_conv3_bn(z)
+        z = self.enc_conv3_bn(z.float())
         z = self.enc_conv3_af(z)
-        z, self.indices3 = self.enc_conv3_pool(z)
+        z, indices3 = self.enc_conv3_pool(z)
 
         z = self.enc_conv4(z)
-        z = self.enc_conv4_bn(z)
+        z = self.enc_conv4_bn(z.float())
         z = self.enc_conv4_af(z)
-        z, self.indices4 = self.enc_conv4_pool(z)
+        z, indices4 = self.enc_conv4_pool(z)
 
         # Dense Encoder Bottleneck
-        z = z.view(z.size(0), -1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor
+        z = torch.flatten(z, 1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor, whatever its memory layout
         z = self.enc_dense1(z)
         z = self.enc_dense1_af(z)
 
@@ -202,9 +229,14 @@ class StandardVAE(torch.nn.Module):
         var = self.enc_dense4_var(z)
         var = self.enc_dense4_var_af(var)
 
-        return (mu, var)
+        # The pooling indices are returned alongside the latent variables since the decoder needs them for unpooling
+        return (mu, var, (indices1, indices2, indices3, indices4))
     
-    def decode(self, z: torch.Tensor) -> torch.Tensor:
+    def decode(self, z: torch.Tensor, indices: Tuple[torch.Tensor]) -> torch.Tensor:
+        # The pooling indices are passed explicitly and all output sizes are derived from the batch dimension of the input
+        indices1, indices2, indices3, indices4 = indices
+        batch = z.size(0)
+
         # Dense Decoder Bottleneck
         y = self.dec_dense4(z)
         y = self.dec_dense4_af(y)
@@ -219,58 +251,80 @@ class StandardVAE(torch.nn.Module):
         y = self.dec_dense1_af(y)
 
         # Convolutional Decoder Network
-        y = torch.reshape(y, [self.batch, 16, self.y_5, self.x_5]) # Converting the 1D tensor (output of dense layers) to a 4D tensor
+        # The input of every BatchNorm layer is cast to float32 so that it never runs in bfloat16 under autocast
+        y = torch.reshape(y, [batch, 16, self.y_5, self.x_5]) # Converting the 1D tensor (output of dense layers) to a 4D tensor
+        y = y.contiguous(memory_format=memory_format(self.settings)) # The only layout conversion of the decoder
         y = self.dec_conv4_pool(
             y,
-            self.indices4,
-            output_size=torch.Size([self.batch, 16, self.y_4, self.x_4]))
+            indices4,
+            output_size=torch.Size([batch, 16, self.y_4, self.x_4]))
         y = self.dec_conv4(y)
-        y = self.dec_conv4_bn(y)
+        y = self.dec_conv4_bn(y.float())
         y = self.dec_conv4_af(y)
 
         y = self.dec_conv3_pool(
             y,
-            self.indices3,
-            output_size=torch.Size([self.batch, 32, self.y_3, self.x_3]))
+            indices3,
+            output_size=torch.Size([batch, 32, self.y_3, self.x_3]))
         y = self.dec_conv3(y)
-        y = self.dec_conv3_bn(y)
+        y = self.dec_conv3_bn(y.float())
         y = self.dec_conv3_af(y)
 
         y = self.dec_conv2_pool(
             y,
-            self.indices2,
-            output_size=torch.Size([self.batch, 64, self.y_2, self.x_2]))
+            indices2,
+            output_size=torch.Size([batch, 64, self.y_2, self.x_2]))
         y = self.dec_conv2(y)
-        y = self.dec_conv2_bn(y)
+        y = self.dec_conv2_bn(y.float())
         y = self.dec_conv2_af(y)
 
         y = self.dec_conv1_pool(
             y,
-            self.indices1,
-            output_size=torch.Size([self.batch, 128, self.input_d[0], self.input_d[1]]))
+            indices1,
+            output_size=torch.Size([batch, 128, self.input_d[0], self.input_d[1]]))
         y = self.dec_conv1(y)
-        y = self.dec_conv1_bn(y)
+        y = self.dec_conv1_bn(y.float())
         y = self.dec_conv1_af(y)
 
         return y
     
     def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor]:
-        mu, logvar = self.encode(x)
+        mu, logvar, indices = self.encode(x)
         std = torch.exp(logvar / 2)
         eps = torch.randn_like(std)
         z = mu + std * eps
-        out = self.decode(z)
+        out = self.decode(z, indices)
         return out, mu, logvar
     
+    def loss_calc(self,
+                  input: torch.Tensor,
+                  out: torch.Tensor,
+                  mu: torch.Tensor,
+                  logvar: torch.Tensor) -> Tuple[torch.Tensor]:
+        # Every loss term is computed per sample in float32 and then averaged over the batch
+        out, mu, logvar = out.float(), mu.float(), logvar.float()
+
+        # KL-Divergence Loss (Regularization loss in VAE Loss function)
+        kl_loss = torch.mul(input=torch.sum(mu.pow(2) + logvar.exp() - logvar - 1, dim=-1), other=0.5)
+
+        # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
+        mse_loss = torch.nn.functional.mse_loss(out, input, reduction='none').flatten(1).mean(dim=1)
+
+        # Total Loss = Regularization Loss + Beta * Reconstruction Loss
+        loss = kl_loss + torch.mul(mse_loss, self.beta)
+
+        return loss.mean(), kl_loss.mean(), mse_loss.mean()
+    
     def testing(self,
                 data_path: str,
                 weight_file: str):
         # Using cuda if available
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print (f'Using device: {device}')
-        network = self.to(device)
+        network = self.to(device, memory_format=memory_format(self.settings)) # The convolution weights use the layout of the images
         network.load_state_dict(torch.load(weight_file)) # Load weights from the .pt file
         network.eval() # Set the network in evalution mode
+        forward = compile_function(network.forward, self.settings)
 
         # Defining Image Transformations
         # 1. Convert the input image to a PyTorch Tensor
@@ -287,52 +341,64 @@ class StandardVAE(torch.nn.Module):
                 torchvision.transforms.Resize(self.input_d)])
 
         # Applying image transformations to the input test dataset
-        dataset = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transforms)        
+        dataset = load_image_folder(data_path, transforms, self.n_chan, self.input_d, self.settings)        
 
         # Set up a Python iterable over the input test dataset
-        test_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=self.batch,
-            shuffle=True,
-            drop_last=True)
+        test_loader = make_loader(dataset, self.batch, True, self.settings)
 
         final_input = []
         final_class = []
         final_output = []
         final_mean = []
         final_var = []
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
         for data in test_loader:
             input, class_name = data
-            final_input.append(input)
-            final_class.append(int(class_name))
+            final_input.extend(input.split(1))
+            final_class.extend(class_name.tolist())
             input = input.to(device)
-            with torch.no_grad():
-                output, mean, logvariance = network.forward(input)
-                final_mean.append(mean)
-                final_var.append(torch.exp(logvariance/2))
-                final_output.append(output)
+            with torch.no_grad(), autocast(self.settings):
+                output, mean, logvariance = forward(input)
+                # The means and standard deviations of the batches are stacked into one tensor at the end, the outputs keep one entry per sample
+                final_mean.append(mean.float())
+                final_var.append(torch.exp(logvariance.float()/2))
+                final_output.extend(output.float().split(1))
+            profiler.step()
+        profiler.stop()
 
         result = dict()
         result['final_input'] = final_input
         result['final_class'] = final_class
         result['final_output'] = final_output
-        result['final_mean'] = final_mean
-        result['final_var'] = final_var
+        result['final_mean'] = torch.cat(final_mean) # (N x n_latent)
+        result['final_var'] = torch.cat(final_var)
         return result
     
+    def validate(self, forward, val_loader, device: torch.device) -> float:
+        # Sum of the per-sample reconstruction losses over the validation dataset
+        # The network is evaluated in evaluation mode, so BatchNorm uses its running statistics and they are not updated by the validation data
+        self.eval()
+        val_loss = torch.zeros((), device=device)
+        with torch.inference_mode(), autocast(self.settings):
+            for input, class_name in val_loader:
+                input = input.to(device)
+                output, mu, logvar = forward(input)
+                val_loss += torch.nn.functional.mse_loss(output.float(), input) * input.size(0)
+        self.train()
+        return float(all_reduce_sum(val_loss)) # Single synchronization with the device (and the other processes) per validation pass
+
     def check(self, curr_score, model, weights_file) :
         if self.best_score==None:
             self.best_score = curr_score
             state_dict = model.state_dict()
-            torch.save(state_dict, weights_file)
+            self.checkpoint_writer.submit(state_dict, weights_file)
         else:
             if self.best_score-curr_score>self.delta:
                 self.best_score = curr_score
                 self.num_bad_epochs = 0
                 state_dict = model.state_dict()
-                torch.save(state_dict, weights_file)
+                self.checkpoint_writer.submit(state_dict, weights_file)
             else:
                 self.num_bad_epochs += 1
         if self.num_bad_epochs==self.patience:
@@ -352,7 +418,7 @@ class StandardVAE(torch.nn.Module):
         print (f'Using device: {device}')
 
         # Set the network in training mode
-        network = self.to(device)
+        network = self.to(device, memory_format=memory_format(self.settings)) # The convolution weights use the layout of the images
         network.train()
 
         # Defining Image Transformations
@@ -370,27 +436,15 @@ class StandardVAE(torch.nn.Module):
                 torchvision.transforms.Resize(self.input_d)])
 
         # Applying image transformations to the input test dataset
-        dataset = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transforms)
+        dataset = load_image_folder(data_path, transforms, self.n_chan, self.input_d, self.settings)
         
-        val_dataset = torchvision.datasets.ImageFolder(
-            root=val_path,
-            transform=transforms)
+        val_dataset = load_image_folder(val_path, transforms, self.n_chan, self.input_d, self.settings)
 
         # Sets up a Python iterable over the input training dataset
-        train_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=self.batch,
-            shuffle=True,
-            drop_last=True)
+        train_loader = make_loader(dataset, self.batch, True, self.settings)
         
         # Sets up a Python iterable over the input validation dataset
-        val_loader = torch.utils.data.DataLoader(
-            dataset=val_dataset,
-            batch_size=self.batch,
-            shuffle=True,
-            drop_last=True)
+        val_loader = make_loader(val_dataset, self.batch, False, self.settings)
 
         # Save the hyperparameters used for training the VAE Network
         hyperparameters = {}
@@ -398,43 +452,95 @@ class StandardVAE(torch.nn.Module):
         hyperparameters["beta"] = self.beta
         hyperparameters["n_chan"] = self.n_chan
         hyperparameters["input_d"] = self.input_d
-        torch.save(hyperparameters, hyperparameters_file)
+        hyperparameters["precision"] = self.settings.get("precision", "fp32")
+        if is_main_process():
+            torch.save(hyperparameters, hyperparameters_file)
 
         # Using Adam Optimizer for training
         optimizer = torch.optim.Adam(network.parameters(), lr=learning_rate)
 
-        for epoch in range(epochs):
-            epoch_loss = 0
+        # The best weights found by early stopping are written to disk in the background
+        self.checkpoint_writer = CheckpointWriter()
+
+        # Continuing an interrupted run from its last full training state
+        state_file = training_state_path(weights_file)
+        start_epoch = 0
+        if self.settings.get("resume", False):
+            if os.path.exists(state_file):
+                start_epoch = restore_training_state(state_file, network, optimizer)
+                print(f'Resuming training from epoch {start_epoch} using {state_file}')
+            else:
+                print(f'No training state found at {state_file}, training from scratch')
+        checkpoint_every = self.settings.get("checkpoint_every", 1) # Epochs between two full training state checkpoints
+        termination = TerminationHandler()
+
+        # Per-epoch means of the loss components, printed and written next to the weights
+        metrics = MetricsAggregator(metrics_path(weights_file), append=start_epoch > 0)
+
+        # In data-parallel training the network is wrapped with DistributedDataParallel, which averages the gradients across the processes
+        model = distribute(network)
+
+        # A single training step (forward pass and loss), compiled as a whole with torch.compile when enabled
+        def train_step(input):
+            with autocast(self.settings):
+                out, mu, logvar = model(input)
+            return network.loss_calc(input, out, mu, logvar)
+        train_step = compile_function(train_step, self.settings)
+        forward = compile_function(network.forward, self.settings)
+        # Wall-clock time of every phase of training, written next to the weights
+        timer = PhaseTimer(device, timing_path(weights_file), append=start_epoch > 0, compiled=self.settings.get("compile", False))
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_train')
+        profiler.start()
+
+        for epoch in range(start_epoch, epochs):
+            memory = MemoryStage(self.settings, 'train_epoch', epoch=epoch)
+            memory.start()
+            timer.start_epoch()
+            set_epoch(train_loader, epoch)
             for data in train_loader:
                 input, class_name = data
                 input = input.to(device)
+                timer.lap('data')
 
-                # Passing the input image through VAE Network
-                out, mu, logvar = network.forward(input)
-
-                # KL-Divergence Loss (Regularization loss in VAE Loss function)
-                kl_loss = torch.mul(input=torch.sum(mu.pow(2) + logvar.exp() - logvar - 1), other=0.5)
-
-                # Mean Square Error Loss (Reconstruction loss in VAE Loss function)
-                mse_loss = torch.nn.functional.mse_loss(out, input)
-
-                # Total Loss = Regularization Loss + Beta * Reconstruction Loss
-                loss = kl_loss + torch.mul(mse_loss, self.beta)
+                # Passing the input batch through VAE Network
+                loss, kl_loss, mse_loss = train_step(input)
+                timer.lap('forward')
 
                 optimizer.zero_grad() # Sets gradients of all model parameters to zero
                 loss.backward() # Perform Back-Propogation
+                timer.lap('backward')
                 optimizer.step() # Performs a single optimization step (parameter update)
-                epoch_loss += loss
-
-            val_loss = 0
-            for data in val_loader:
-                input, class_name = data
-                input = input.to(device)
-                output, mu, logvar = network.forward(input)
-                mse_val_loss = torch.nn.functional.mse_loss(output, input)
-                val_loss += mse_val_loss
-            if self.check(val_loss, network, weights_file):
+                timer.lap('optimizer')
+                profiler.step()
+                metrics.update(input.size(0), loss, KL=kl_loss, MSE=mse_loss)
+
+                # On SIGTERM the current state is saved and the interrupted epoch is run again when resuming
+                if termination.poll():
+                    if is_main_process():
+                        self.checkpoint_writer.submit(training_state(epoch, network, optimizer), state_file)
+                    self.checkpoint_writer.close()
+                    print(f'Training interrupted at epoch {epoch}, the training state was saved to {state_file}')
+                    sys.exit(143)
+                timer.lap('bookkeeping') # Metrics, profiler and SIGTERM poll of the step
+                timer.end_step(input.size(0))
+
+            val_loss = self.validate(forward, val_loader, device)
+            metrics.emit(epoch, val_loss)
+            timer.lap('validation')
+            # Rank 0 decides on early stopping and writes the checkpoints, the other processes follow its decision
+            stop = self.check(val_loss, network, weights_file) if is_main_process() else False
+            stop = broadcast_flag(stop)
+            if not stop and checkpoint_every > 0 and (epoch + 1) % checkpoint_every == 0 and is_main_process():
+                self.checkpoint_writer.submit(training_state(epoch + 1, network, optimizer), state_file)
+            timer.lap('checkpoint')
+            timer.end_epoch(epoch, epochs)
+            memory.stop(timer.samples)
+            if stop:
                 print(f'Early Stopping at epoch {epoch}')
                 break
-            print(f'Epoch: {epoch}; Training Loss: {epoch_loss}; Validation Loss: {val_loss}')
+        profiler.stop()
+        if is_main_process():
+            timer.report()
+        self.checkpoint_writer.close() # Waits until the best weights are on disk
+        termination.restore()
         print('Training finished, saving weights...')
\ No newline at end of file
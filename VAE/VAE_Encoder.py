@@ -3,16 +3,25 @@ import torch
 import torchvision
 import math
 
+from utils.data import load_image_folder
+from utils.data import make_loader
+from utils.runtime import autocast
+from utils.runtime import compile_function
+from utils.runtime import memory_format
+from utils.profiling import StepProfiler
+
 class VAE_Encoder(torch.nn.Module):
     def __init__(self,
                  n_latent: int,
                  n_chan: int,
                  input_d: Tuple[int],
-                 batch: int = 1) -> None:
+                 batch: int = 1,
+                 settings: dict = None) -> None:
         super(VAE_Encoder, self).__init__()
         # Initializing the class variables
         self.n_latent = n_latent
         self.batch = batch
+        self.settings = settings if settings is not None else dict() # Settings that control how the model is executed
         self.n_chan = n_chan
         self.input_d = input_d
 
@@ -102,29 +111,30 @@ class VAE_Encoder(torch.nn.Module):
 
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         # Convolutional Encoder Network
+        # The input of every BatchNorm layer is cast to float32 so that it never runs in bfloat16 under autocast
         z = x
         z = self.enc_conv1(z)
-        z = self.enc_conv1_bn(z)
+        z = self.enc_conv1_bn(z.float())
         z = self.enc_conv1_af(z)
-        z, self.indices1 = self.enc_conv1_pool(z)
+        z, _ = self.enc_conv1_pool(z)
 
         z = self.enc_conv2(z)
-        z = self.enc_conv2_bn(z)
+        z = self.enc_conv2_bn(z.float())
         z = self.enc_conv2_af(z)
-        z, self.indices2 = self.enc_conv2_pool(z)
+        z, _ = self.enc_conv2_pool(z)
 
         z = self.enc_conv3(z)
-        z = self.enc_conv3_bn(z)
+        z = self.enc_conv3_bn(z.float())
         z = self.enc_conv3_af(z)
-        z, self.indices3 = self.enc_conv3_pool(z)
+        z, _ = self.enc_conv3_pool(z)
 
         z = self.enc_conv4(z)
-        z = self.enc_conv4_bn(z)
+        z = self.enc_conv4_bn(z.float())
         z = self.enc_conv4_af(z)
-        z, self.indices4 = self.enc_conv4_pool(z)
+        z, _ = self.enc_conv4_pool(z)
 
         # Dense Encoder Bottleneck
-        z = z.view(z.size(0), -1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor
+        z = torch.flatten(z, 1) # Converting a 4D tensor (output of convolutional layer) to 1D tensor, whatever its memory layout
         z = self.enc_dense1(z)
         z = self.enc_dense1_af(z)
 
@@ -148,9 +158,10 @@ class VAE_Encoder(torch.nn.Module):
         # Using cuda if available
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print (f'Using device: {device}')
-        network = self.to(device)
+        network = self.to(device, memory_format=memory_format(self.settings)) # The convolution weights use the layout of the images
         network.load_state_dict(torch.load(weight_file)) # Load weights from the .pt file
         network.eval() # Set the network in evalution mode
+        encode = compile_function(network.encode, self.settings)
 
         # Defining Image Transformations
         # 1. Convert the input image to a PyTorch Tensor
@@ -167,34 +178,33 @@ class VAE_Encoder(torch.nn.Module):
                 torchvision.transforms.Resize(self.input_d)])
 
         # Applying image transformations to the input test dataset
-        dataset = torchvision.datasets.ImageFolder(
-            root=data_path,
-            transform=transforms)        
+        dataset = load_image_folder(data_path, transforms, self.n_chan, self.input_d, self.settings)        
 
         # Set up a Python iterable over the input test dataset
-        test_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=self.batch,
-            shuffle=True,
-            drop_last=True)
-
-        final_input = []
-        final_class = []
-        final_mean = []
-        final_var = []
-        for data in test_loader:
-            input, class_name = data
-            final_input.append(input)
-            final_class.append(int(class_name))
+        # The samples are read in the order of the dataset, so that row i of every output belongs to the file final_path[i]
+        test_loader = make_loader(dataset, self.settings.get("extract_batch_size", 64), False, self.settings)
+
+        # The outputs of every batch are written into preallocated (N x n_latent) tensors and the input images are not kept
+        n = len(dataset)
+        final_mean = torch.empty((n, self.n_latent))
+        final_var = torch.empty((n, self.n_latent))
+        start = 0
+        profiler = StepProfiler(self.settings, f'{type(self).__name__}_testing')
+        profiler.start()
+        for input, _ in test_loader:
+            end = start + input.size(0)
             input = input.to(device)
-            with torch.no_grad():
-                mean, logvariance = network.encode(input)
-                final_mean.append(mean)
-                final_var.append(torch.exp(logvariance/2))
+            with torch.inference_mode(), autocast(self.settings):
+                mean, logvariance = encode(input)
+                final_mean[start:end] = mean.float()
+                final_var[start:end] = torch.exp(logvariance.float()/2)
+            start = end
+            profiler.step()
+        profiler.stop()
 
         result = dict()
-        result['final_input'] = final_input
-        result['final_class'] = final_class
+        result['final_path'] = [path for path, _ in dataset.samples]
+        result['final_class'] = list(dataset.targets)
         result['final_mean'] = final_mean
         result['final_var'] = final_var
         return result
\ No newline at end of file
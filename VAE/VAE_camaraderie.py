@@ -7,9 +7,13 @@ from VAE.VAE_Encoder import VAE_Encoder
 
 from VAE.VAE_train import VAE_Trainer
 from VAE.VAE_train import NumVAE_Trainer
+from utils.memory import MemoryStage
+from utils.sampling import flatten_draws
+from utils.sampling import majority_vote
+from utils.sampling import sample_latent
 
 class VAE_CAMARADERIE:
-    def __init__(self, n_chan, input_d, n_latent, beta, train_dataset, val_dataset, test_dataset, encoder_weights_path, weights_path, hyperparameters_path):
+    def __init__(self, n_chan, input_d, n_latent, beta, train_dataset, val_dataset, test_dataset, encoder_weights_path, weights_path, hyperparameters_path, settings=None):
         super(VAE_CAMARADERIE, self).__init__()
         self.n_latent = n_latent
         self.beta = beta
@@ -23,8 +27,9 @@ class VAE_CAMARADERIE:
         self.encoder_weights_path = encoder_weights_path
         self.weights_path = weights_path
         self.hyperparameters_path = hyperparameters_path
+        self.settings = settings if settings is not None else dict()
 
-        self.trainer = VAE_Trainer(self.n_latent, self.beta, self.n_chan, self.input_d, self.train_dataset, self.val_dataset, self.weights_path, self.hyperparameters_path)
+        self.trainer = VAE_Trainer(self.n_latent, self.beta, self.n_chan, self.input_d, self.train_dataset, self.val_dataset, self.weights_path, self.hyperparameters_path, self.settings)
 
     def train(self):
         self.trainer.train()
@@ -37,12 +42,14 @@ class VAE_CAMARADERIE:
         self.trainer.reconstruct()
 
     def convert(self):
+        memory = MemoryStage(self.settings, 'convert')
+        memory.start()
         print(f'Converting model {self.weights_path} to encoder-only version...\n')
         full_model = torch.load(self.weights_path) # Load the weights stored in the .pt file
         self.hyperparameters = torch.load(self.hyperparameters_path)
 
         # Creating an instance of Encoder-only Network
-        self.encoder = VAE_Encoder(self.n_latent, self.n_chan, self.input_d)
+        self.encoder = VAE_Encoder(self.n_latent, self.n_chan, self.input_d, settings=self.settings)
 
         # Extracting the encoder only portion of the VAE Network
         encoder_dict = self.encoder.state_dict()
@@ -51,9 +58,12 @@ class VAE_CAMARADERIE:
 
         # Saving the weights of the Encoder network in another .pt file
         torch.save(encoder_dict, self.encoder_weights_path)
+        memory.stop()
         print("Conversion to Encoder-only Network complete")
 
     def extract(self):
+        memory = MemoryStage(self.settings, 'extract')
+        memory.start()
         print(f'Starting feature extraction for input size {self.hyperparameters["input_d"]}')
         print(f'n_latent={self.hyperparameters["n_latent"]}')
         print(f'Using data set {self.test_dataset}')
@@ -61,31 +71,27 @@ class VAE_CAMARADERIE:
         result = self.encoder.testing(self.test_dataset, self.encoder_weights_path)
         ClientB_class = result['final_class']
 
-        ClientB_features = []
-        for i in range(len(result["final_mean"])):
-            eps = torch.randn_like(result["final_var"][i])
-            mean_cpu = result["final_mean"][i].cpu().detach().numpy()
-            variance_cpu = result["final_var"][i].cpu().detach().numpy()
-            eps = eps.cpu().detach().numpy()
-            z = mean_cpu + variance_cpu * eps
-            ClientB_features.append(z)
+        # A single vectorized draw for all the samples
+        ClientB_features = sample_latent(result["final_mean"], result["final_var"], self.settings, stream=0)
         print("Feature extraction complete")
 
+        memory.stop(len(ClientB_class))
         return ClientB_features, ClientB_class
 
     def classify(self, ClientB_features, ClientB_class):
         ClientA_features, ClientA_class = self.trainer.latent()
+        memory = MemoryStage(self.settings, 'classify')
+        memory.start()
 
-        ClientA_Z_tensor = torch.squeeze(torch.tensor(ClientA_features))
-        ClientA_Z_numpy = ClientA_Z_tensor.cpu().detach().numpy()
-
-        ClientB_Z_tensor = torch.squeeze(torch.tensor(ClientB_features))
-        ClientB_Z_numpy = ClientB_Z_tensor.cpu().detach().numpy()
+        # The features are NumPy arrays of shape (N x n_latent), or (N x K x n_latent) with K draws per sample
+        # Every draw of a Client A sample is a training example and every Client B sample gets the majority vote of its draws
+        ClientA_Z, ClientA_labels = flatten_draws(ClientA_features, ClientA_class)
+        ClientB_Z, _ = flatten_draws(ClientB_features, ClientB_class)
 
         classifier = SVC(gamma='auto', kernel='poly')
-        classifier.fit(ClientA_Z_numpy, ClientA_class)
+        classifier.fit(ClientA_Z, ClientA_labels)
 
-        result = classifier.predict(ClientB_Z_numpy)
+        result = majority_vote(classifier.predict(ClientB_Z), len(ClientB_class))
 
         actual_negative_instances = ClientB_class.count(0)
         actual_positive_instances = ClientB_class.count(1)
@@ -111,8 +117,14 @@ class VAE_CAMARADERIE:
         print(f"Number of predictions belonging to negative class is {total_negative_prediction}")
         print(f"Out of all the predictions made by the model, number of predictions that are correct for the negative class is {predicted_negative_instances}")
 
+        accuracy = (predicted_positive_instances + predicted_negative_instances) / len(ClientB_class)
+        print()
+        print(f"Accuracy of the model on the test dataset is {accuracy}")
+        memory.stop(len(ClientA_class) + len(ClientB_class))
+        return accuracy
+
 class VAE_NumCAMARADERIE:
-    def __init__(self, n_latent, beta, train_dataset, val_dataset, test_dataset, train_labels, val_labels, test_labels, encoder_weights_path, weights_path, hyperparameters_path):
+    def __init__(self, n_latent, beta, train_dataset, val_dataset, test_dataset, train_labels, val_labels, test_labels, encoder_weights_path, weights_path, hyperparameters_path, settings=None):
         super(VAE_NumCAMARADERIE, self).__init__()
         self.n_latent = n_latent
         self.beta = beta
@@ -127,8 +139,9 @@ class VAE_NumCAMARADERIE:
         self.encoder_weights_path = encoder_weights_path
         self.weights_path = weights_path
         self.hyperparameters_path = hyperparameters_path
+        self.settings = settings if settings is not None else dict()
 
-        self.trainer = NumVAE_Trainer(self.n_latent, self.beta, self.train_dataset, self.val_dataset, self.train_labels, self.val_labels, self.weights_path, self.hyperparameters_path)
+        self.trainer = NumVAE_Trainer(self.n_latent, self.beta, self.train_dataset, self.val_dataset, self.train_labels, self.val_labels, self.weights_path, self.hyperparameters_path, self.settings)
 
     def train(self):
         self.trainer.train()
@@ -138,12 +151,14 @@ class VAE_NumCAMARADERIE:
         self.trainer.visualize(ClientA_features, ClientA_Class)
 
     def convert(self):
+        memory = MemoryStage(self.settings, 'convert')
+        memory.start()
         print(f'Converting model {self.weights_path} to encoder-only version...\n')
         full_model = torch.load(self.weights_path) # Load the weights stored in the .pt file
         self.hyperparameters = torch.load(self.hyperparameters_path)
 
         # Creating an instance of Encoder-only Network
-        self.encoder = NumVAE_Encoder(self.n_latent, self.train_dataset.shape[1])
+        self.encoder = NumVAE_Encoder(self.n_latent, self.train_dataset.shape[1], self.settings)
 
         # Extracting the encoder only portion of the VAE Network
         encoder_dict = self.encoder.state_dict()
@@ -152,41 +167,39 @@ class VAE_NumCAMARADERIE:
 
         # Saving the weights of the Encoder network in another .pt file
         torch.save(encoder_dict, self.encoder_weights_path)
+        memory.stop()
         print("Conversion to Encoder-only Network complete")
 
     def extract(self):
+        memory = MemoryStage(self.settings, 'extract')
+        memory.start()
         print(f'n_latent={self.hyperparameters["n_latent"]}')
 
         result = self.encoder.testing(self.test_dataset, self.test_labels, self.encoder_weights_path)
         ClientB_class = result['final_class']
 
-        torch.manual_seed(0)
-        ClientB_features = []
-        for i in range(len(result["final_mean"])):
-            eps = torch.randn_like(result["final_var"][i])
-            mean_cpu = result["final_mean"][i].cpu().detach().numpy()
-            variance_cpu = result["final_var"][i].cpu().detach().numpy()
-            eps = eps.cpu().detach().numpy()
-            z = mean_cpu + variance_cpu * eps
-            ClientB_features.append(z)
+        # A single vectorized draw for all the samples
+        ClientB_features = sample_latent(result["final_mean"], result["final_var"], self.settings, stream=0)
 
         print("Feature extraction complete")
 
+        memory.stop(len(ClientB_class))
         return ClientB_features, ClientB_class
 
     def classify(self, ClientB_negative_features, ClientB_class):
         ClientA_features, ClientA_class = self.trainer.latent()
+        memory = MemoryStage(self.settings, 'classify')
+        memory.start()
 
-        ClientA_Z_tensor = torch.squeeze(torch.tensor(ClientA_features))
-        ClientA_Z_numpy = ClientA_Z_tensor.cpu().detach().numpy()
-
-        ClientB_Z_tensor = torch.squeeze(torch.tensor(ClientB_negative_features))
-        ClientB_Z_numpy = ClientB_Z_tensor.cpu().detach().numpy()
+        # The features are NumPy arrays of shape (N x n_latent), or (N x K x n_latent) with K draws per sample
+        # Every draw of a Client A sample is a training example and every Client B sample gets the majority vote of its draws
+        ClientA_Z, ClientA_labels = flatten_draws(ClientA_features, ClientA_class)
+        ClientB_Z, _ = flatten_draws(ClientB_negative_features, ClientB_class)
 
         classifier = SVC(gamma='auto', kernel='poly')
-        classifier.fit(ClientA_Z_numpy, ClientA_class)
+        classifier.fit(ClientA_Z, ClientA_labels)
 
-        result = classifier.predict(ClientB_Z_numpy)
+        result = majority_vote(classifier.predict(ClientB_Z), len(ClientB_class))
 
         actual_negative_instances = ClientB_class.count(0)
         actual_positive_instances = ClientB_class.count(1)
@@ -210,4 +223,10 @@ class VAE_NumCAMARADERIE:
         print()
         print(f"Number of images belonging to negative class in the test dataset is {actual_negative_instances}")
         print(f"Number of predictions belonging to negative class is {total_negative_prediction}")
-        print(f"Out of all the predictions made by the model, number of predictions that are correct for the negative class is {predicted_negative_instances}")
\ No newline at end of file
+        print(f"Out of all the predictions made by the model, number of predictions that are correct for the negative class is {predicted_negative_instances}")
+
+        accuracy = (predicted_positive_instances + predicted_negative_instances) / len(ClientB_class)
+        print()
+        print(f"Accuracy of the model on the test dataset is {accuracy}")
+        memory.stop(len(ClientA_class) + len(ClientB_class))
+        return accuracy
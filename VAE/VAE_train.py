@@ -1,3 +1,4 @@
+import functools
 import torch
 import torchvision
 import matplotlib.pyplot as plt
@@ -6,16 +7,21 @@ import os
 
 from VAE.VAE import StandardVAE
 from VAE.NumVAE import NumStandardVAE
+from utils.distributed import launch
+from utils.memory import MemoryStage
+from utils.sampling import sample_latent
 
 class VAE_Trainer:
-    def __init__(self, n_latent, beta, n_chan, input_d, train_path, val_path, weights_path, hyperparameters_path):
+    def __init__(self, n_latent, beta, n_chan, input_d, train_path, val_path, weights_path, hyperparameters_path, settings=None):
         super(VAE_Trainer, self).__init__()
         self.n_latent = n_latent
         self.beta = beta
         self.input_d = input_d
         self.n_chan = n_chan
-        self.num_epochs = 100
+        self.settings = settings if settings is not None else dict()
+        self.num_epochs = self.settings.get("epochs", 100)
         self.lr = 1e-4
+        self.batch_size = self.settings.get("batch_size", 1)
 
         self.dataset = train_path
         self.validation_dataset = val_path
@@ -27,16 +33,24 @@ class VAE_Trainer:
             self.n_latent,
             self.beta,
             self.n_chan,
-            self.input_d
+            self.input_d,
+            self.batch_size,
+            self.settings
         )
         
     def train(self):
         print(f'beta={self.beta}')
         print(f'n_latent={self.n_latent}')
+        print(f'batch_size={self.batch_size}')
+        print(f'precision={self.settings.get("precision", "fp32")}')
         print(f'Using data set {self.dataset}')
 
         # Training the created VAE instance on the labelled dataset at Client A
-        self.ClientA_Network.train_self(
+        # With world_size > 1 the network is trained by several processes together, each on its own shard of the dataset
+        train_self = self.ClientA_Network.train_self
+        if self.settings.get("world_size", 1) > 1:
+            train_self = functools.partial(launch, train_self, self.settings)
+        train_self(
             data_path=self.dataset,
             val_path=self.validation_dataset,
             epochs=self.num_epochs,
@@ -45,27 +59,23 @@ class VAE_Trainer:
             hyperparameters_file = self.hyperparameters_path)
 
     def latent(self):
+        memory = MemoryStage(self.settings, 'latent')
+        memory.start()
         result = self.ClientA_Network.testing(data_path=self.dataset, weight_file=self.weights_path)
 
         ClientA_class = result["final_class"]
 
-        # Extracting latent space representation of each image in the training dataset
-        ClientA_Z = []
-        for i in range(len(result["final_mean"])):
-            eps = torch.randn_like(result["final_var"][i])
-            mean_cpu = result["final_mean"][i].cpu().detach().numpy()
-            variance_cpu = result["final_var"][i].cpu().detach().numpy()
-            eps = eps.cpu().detach().numpy()
-            z = mean_cpu + variance_cpu * eps
-            ClientA_Z.append(z)
+        # Extracting latent space representation of each image in the training dataset, in a single vectorized draw
+        ClientA_Z = sample_latent(result["final_mean"], result["final_var"], self.settings, stream=1)
 
+        memory.stop(len(ClientA_class))
         return ClientA_Z, ClientA_class
 
     def visualize(self, ClientA_Z, ClientA_class):
         colors = ['red','green']
-        for i in range(len(ClientA_Z)):
-            z = ClientA_Z[i]
-            plt.scatter(z[0][0], z[0][1], c=colors[ClientA_class[i]])
+        # With several draws per sample only the first one is plotted
+        Z = ClientA_Z if ClientA_Z.ndim == 2 else ClientA_Z[:, 0]
+        plt.scatter(Z[:, 0], Z[:, 1], c=[colors[c] for c in ClientA_class])
         plt.savefig("./latent.png", format="png")
     
     def reconstruct(self):
@@ -101,12 +111,14 @@ class VAE_Trainer:
             image.save(f'./Reconstruction/reconstruction_{i}.jpg')
 
 class NumVAE_Trainer:
-    def __init__(self, n_latent, beta, train_data, val_data, train_labels, val_labels, weights_path, hyperparameters_path):
+    def __init__(self, n_latent, beta, train_data, val_data, train_labels, val_labels, weights_path, hyperparameters_path, settings=None):
         super(NumVAE_Trainer, self).__init__()
         self.n_latent = n_latent
         self.beta = beta
-        self.num_epochs = 100
+        self.settings = settings if settings is not None else dict()
+        self.num_epochs = self.settings.get("epochs", 100)
         self.lr = 1e-4
+        self.batch_size = self.settings.get("batch_size", 1)
 
         self.dataset = train_data
         self.validation_dataset = val_data
@@ -119,15 +131,23 @@ class NumVAE_Trainer:
         self.ClientA_Network = NumStandardVAE(
             self.n_latent,
             self.beta,
-            self.dataset.shape[1]
+            self.dataset.shape[1],
+            self.batch_size,
+            self.settings
         )
         
     def train(self):
         print(f'beta={self.beta}')
         print(f'n_latent={self.n_latent}')
+        print(f'batch_size={self.batch_size}')
+        print(f'precision={self.settings.get("precision", "fp32")}')
 
         # Training the created VAE instance on the labelled dataset at Client A
-        self.ClientA_Network.train_self(
+        # With world_size > 1 the network is trained by several processes together, each on its own shard of the dataset
+        train_self = self.ClientA_Network.train_self
+        if self.settings.get("world_size", 1) > 1:
+            train_self = functools.partial(launch, train_self, self.settings)
+        train_self(
             train_data=self.dataset,
             val_data=self.validation_dataset,
             epochs=self.num_epochs,
@@ -136,26 +156,21 @@ class NumVAE_Trainer:
             hyperparameters_file = self.hyperparameters_path)
 
     def latent(self):
+        memory = MemoryStage(self.settings, 'latent')
+        memory.start()
         result = self.ClientA_Network.testing(test_data=self.dataset, labels=self.train_labels, weight_file=self.weights_path)
 
         ClientA_class = result["final_class"]
 
-        torch.manual_seed(0)
-        # Extracting latent space representation of each image in the training dataset
-        ClientA_Z = []
-        for i in range(len(result["final_mean"])):
-            eps = torch.randn_like(result["final_var"][i])
-            mean_cpu = result["final_mean"][i].cpu().detach().numpy()
-            variance_cpu = result["final_var"][i].cpu().detach().numpy()
-            eps = eps.cpu().detach().numpy()
-            z = mean_cpu + variance_cpu * eps
-            ClientA_Z.append(z)
+        # Extracting latent space representation of each image in the training dataset, in a single vectorized draw
+        ClientA_Z = sample_latent(result["final_mean"], result["final_var"], self.settings, stream=1)
 
+        memory.stop(len(ClientA_class))
         return ClientA_Z, ClientA_class
 
     def visualize(self, ClientA_Z, ClientA_class):
         colors = ['red','green']
-        for i in range(len(ClientA_Z)):
-            z = ClientA_Z[i]
-            plt.scatter(z[0], z[1], c=colors[ClientA_class[i]])
+        # With several draws per sample only the first one is plotted
+        Z = ClientA_Z if ClientA_Z.ndim == 2 else ClientA_Z[:, 0]
+        plt.scatter(Z[:, 0], Z[:, 1], c=[colors[c] for c in ClientA_class])
         plt.savefig("./latent.png", format="png")
\ No newline at end of file
@@ -1,4 +1,5 @@
 import argparse
+import datetime
 import torch
 import pandas as pd
 from sklearn import preprocessing
@@ -8,6 +9,11 @@ from DCSAE.DCSAE_camaraderie import NumCAMARADERIE
 from VAE.VAE_camaraderie import VAE_CAMARADERIE
 from VAE.VAE_camaraderie import VAE_NumCAMARADERIE
 from preprocess import DataLoader
+from sweep import Sweep
+from utils.data import default_num_workers
+from utils.data import reserve_loader_cores
+from utils.memory import MemoryStage
+from utils.memory import memory_summary
 
 parser = argparse.ArgumentParser()
 
@@ -24,6 +30,47 @@ parser.add_argument('--rho', type=float)
 parser.add_argument('--weights', type=str)
 parser.add_argument('--hyperparameters', type=str)
 
+# Execution Settings
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--extract_batch_size', type=int, default=64)
+parser.add_argument('--extract_memory_mb', type=int, default=256)
+parser.add_argument('--latent_sampling', type=str, default='sample', choices=['sample', 'mean'])
+parser.add_argument('--latent_samples', type=int, default=1)
+parser.add_argument('--latent_seed', type=int, default=0)
+parser.add_argument('--image_cache', type=str, default='none', choices=['none', 'ram', 'disk'])
+parser.add_argument('--cache_dir', type=str, default='./cache')
+parser.add_argument('--num_workers', type=int)
+parser.add_argument('--prefetch_factor', type=int, default=2)
+parser.add_argument('--persistent_workers', action=argparse.BooleanOptionalAction, default=True)
+parser.add_argument('--pin_memory', action='store_true')
+parser.add_argument('--worker_affinity', action='store_true')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'])
+parser.add_argument('--compile', action='store_true')
+parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'])
+parser.add_argument('--channels_last', action='store_true')
+parser.add_argument('--resume', action='store_true')
+parser.add_argument('--checkpoint_every', type=int, default=1)
+parser.add_argument('--world_size', type=int, default=1)
+parser.add_argument('--separation_metric', type=str, default='none', choices=['none', 'distance', 'centroid'])
+parser.add_argument('--separation_samples', type=int, default=512)
+parser.add_argument('--separation_patience', type=int)
+parser.add_argument('--profile', action='store_true')
+parser.add_argument('--profile_wait', type=int, default=1)
+parser.add_argument('--profile_warmup', type=int, default=1)
+parser.add_argument('--profile_steps', type=int, default=5)
+parser.add_argument('--profile_top', type=int, default=20)
+parser.add_argument('--profile_dir', type=str, default='./profile')
+parser.add_argument('--memory_report', type=str)
+
+# Hyperparameter Sweep
+parser.add_argument('--search_space', type=str)
+parser.add_argument('--sweep_dir', type=str, default='./sweep')
+parser.add_argument('--parallel_trials', type=int, default=1)
+parser.add_argument('--threads_per_trial', type=int)
+parser.add_argument('--min_epochs', type=int, default=5)
+parser.add_argument('--max_epochs', type=int, default=100)
+parser.add_argument('--eta', type=int, default=3)
+
 # Case 1 : Convolutional Networks
 # Hyperparameters
 parser.add_argument('--n_chan', type=int)
@@ -55,29 +102,72 @@ if args.input_d != None:
 
 eps = 1e-5
 
+# Settings that control how the models are executed (they do not change the model itself)
+settings = dict()
+settings["batch_size"] = args.batch_size
+settings["extract_batch_size"] = args.extract_batch_size
+settings["extract_memory_mb"] = args.extract_memory_mb
+settings["latent_sampling"] = args.latent_sampling
+settings["latent_samples"] = args.latent_samples
+settings["latent_seed"] = args.latent_seed
+settings["image_cache"] = args.image_cache
+settings["cache_dir"] = args.cache_dir
+settings["num_workers"] = args.num_workers if args.num_workers != None else default_num_workers()
+settings["prefetch_factor"] = args.prefetch_factor
+settings["persistent_workers"] = args.persistent_workers
+settings["pin_memory"] = args.pin_memory
+settings["worker_affinity"] = args.worker_affinity
+settings["precision"] = args.precision
+settings["compile"] = args.compile
+settings["compile_mode"] = args.compile_mode
+settings["channels_last"] = args.channels_last
+settings["resume"] = args.resume
+settings["checkpoint_every"] = args.checkpoint_every
+settings["world_size"] = args.world_size
+settings["separation_metric"] = args.separation_metric
+settings["separation_samples"] = args.separation_samples
+settings["separation_patience"] = args.separation_patience
+settings["profile"] = args.profile
+settings["profile_wait"] = args.profile_wait
+settings["profile_warmup"] = args.profile_warmup
+settings["profile_steps"] = args.profile_steps
+settings["profile_top"] = args.profile_top
+settings["profile_dir"] = args.profile_dir
+settings["memory_report"] = args.memory_report
+settings["memory_run"] = datetime.datetime.now().isoformat(timespec="seconds") # Identifies the records of this run in the memory report
+
+if (args.type=="image"):
+    reserve_loader_cores(settings["num_workers"])
+
 if not (args.train_path == None):
-    train_df = pd.read_csv(args.train_path)
-    train_labels = torch.Tensor(train_df["y"])
-    train_df.drop(["y"], axis=1, inplace=True)
-    train_scaler = preprocessing.StandardScaler().fit(train_df)
-    train_data = train_scaler.transform(train_df)
-    train_data = torch.Tensor(train_data) + eps
+    with MemoryStage(settings, 'load', dataset=args.train_path) as stage:
+        train_df = pd.read_csv(args.train_path)
+        train_labels = torch.Tensor(train_df["y"])
+        train_df.drop(["y"], axis=1, inplace=True)
+        train_scaler = preprocessing.StandardScaler().fit(train_df)
+        train_data = train_scaler.transform(train_df)
+        train_data = torch.Tensor(train_data) + eps
+        stage.samples = len(train_data)
 
 if not (args.val_path == None):
-    val_df = pd.read_csv(args.val_path)
-    val_labels = torch.Tensor(val_df["y"])
-    val_df.drop(["y"], axis=1, inplace=True)
-    val_scaler = preprocessing.StandardScaler().fit(val_df)
-    val_data = val_scaler.transform(val_df)
-    val_data = torch.Tensor(val_data) + eps
+    with MemoryStage(settings, 'load', dataset=args.val_path) as stage:
+        val_df = pd.read_csv(args.val_path)
+        val_labels = torch.Tensor(val_df["y"])
+        val_df.drop(["y"], axis=1, inplace=True)
+        val_scaler = preprocessing.StandardScaler().fit(val_df)
+        val_data = val_scaler.transform(val_df)
+        val_data = torch.Tensor(val_data) + eps
+        stage.samples = len(val_data)
 
 if not (args.test_path == None):
-    test_df = pd.read_csv(args.test_path)
-    test_labels = torch.Tensor(test_df["y"])
-    test_df.drop(["y"], axis=1, inplace=True)
-    test_scaler = preprocessing.StandardScaler().fit(test_df)
-    test_data = test_scaler.transform(test_df)
-    test_data = torch.Tensor(test_data) + eps
+    with MemoryStage(settings, 'load', dataset=args.test_path) as stage:
+        test_df = pd.read_csv(args.test_path)
+        test_labels = torch.Tensor(test_df["y"])
+        test_df.drop(["y"], axis=1, inplace=True)
+        test_scaler = preprocessing.StandardScaler().fit(test_df)
+        test_data = test_scaler.transform(test_df)
+        test_data = torch.Tensor(test_data) + eps
+        stage.samples = len(test_data)
 
 if (args.task=="create"):
     if not (args.train_size == None or args.test_size == None or args.positive_set == None or args.negative_set == None):
@@ -91,14 +181,14 @@ elif (args.task=="train"):
     model = None
     if (args.model == "dcsae"):
         if (args.type=="image"):
-            model = CAMARADERIE(args.n_chan, input_dimensions, args.n_latent, args.alpha, args.beta, args.gamma, args.rho, train_dataset, validation_dataset, test_dataset, encoder_weights_path, weights_path, hyperparameters_path)
+            model = CAMARADERIE(args.n_chan, input_dimensions, args.n_latent, args.alpha, args.beta, args.gamma, args.rho, train_dataset, validation_dataset, test_dataset, encoder_weights_path, weights_path, hyperparameters_path, settings)
         elif (args.type=="num"):
-            model = NumCAMARADERIE(args.n_latent, args.alpha, args.beta, args.gamma, args.rho, train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, weights_path, hyperparameters_path)
+            model = NumCAMARADERIE(args.n_latent, args.alpha, args.beta, args.gamma, args.rho, train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, weights_path, hyperparameters_path, settings)
     elif (args.model == "vae"):
         if (args.type=="image"):
-            model = VAE_CAMARADERIE(args.n_chan, input_dimensions, args.n_latent, args.beta, train_dataset, validation_dataset, test_dataset, encoder_weights_path, weights_path, hyperparameters_path)
+            model = VAE_CAMARADERIE(args.n_chan, input_dimensions, args.n_latent, args.beta, train_dataset, validation_dataset, test_dataset, encoder_weights_path, weights_path, hyperparameters_path, settings)
         elif (args.type=="num"):
-            model = VAE_NumCAMARADERIE(args.n_latent, args.beta, train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, weights_path, hyperparameters_path)
+            model = VAE_NumCAMARADERIE(args.n_latent, args.beta, train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, weights_path, hyperparameters_path, settings)
     model.train()
 
 elif (args.task=="visualise"):
@@ -106,23 +196,23 @@ elif (args.task=="visualise"):
     model = None
     if (args.model == "dcsae"):
         if (args.type=="image"):
-            model = CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters)
+            model = CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters, settings)
         elif (args.type=="num"):
-            model = NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters)
+            model = NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters, settings)
     elif (args.model == "vae"):
         if (args.type=="image"):
-            model = VAE_CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["beta"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters)
+            model = VAE_CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["beta"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters, settings)
         elif (args.type=="num"):
-            model = VAE_NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["beta"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters)
+            model = VAE_NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["beta"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters, settings)
  
     model.visualise()
 
 elif (args.task=="reconstruct"):
     hyperparameters = torch.load(args.hyperparameters)
     if (args.model == "dcsae"):
-        model = CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters)
+        model = CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters, settings)
     elif (args.model == "vae"):
-        model = VAE_CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["beta"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters)
+        model = VAE_CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["beta"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters, settings)
     model.reconstruct()
 
 elif (args.task=="classify"):
@@ -130,14 +220,31 @@ elif (args.task=="classify"):
     model = None
     if (args.model == "dcsae"):
         if (args.type=="image"):
-            model = CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters)
+            model = CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters, settings)
         elif (args.type=="num"):
-            model = NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters)
+            model = NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["alpha"], hyperparameters["beta"], hyperparameters["gamma"], hyperparameters["rho"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters, settings)
     elif (args.model == "vae"):
         if (args.type=="image"):
-            model = VAE_CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["beta"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters)
+            model = VAE_CAMARADERIE(hyperparameters["n_chan"], hyperparameters["input_d"], hyperparameters["n_latent"], hyperparameters["beta"], train_dataset, validation_dataset, test_dataset, encoder_weights_path, args.weights, args.hyperparameters, settings)
         elif (args.type=="num"):
-            model = VAE_NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["beta"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters)
+            model = VAE_NumCAMARADERIE(hyperparameters["n_latent"], hyperparameters["beta"], train_data, val_data, test_data, train_labels, val_labels, test_labels, encoder_weights_path, args.weights, args.hyperparameters, settings)
     model.convert()
     ClientB_negative_features, ClientB_class = model.extract()
     model.classify(ClientB_negative_features, ClientB_class)
+
+elif (args.task=="sweep"):
+    # Hyperparameters that are not part of the search space keep the values given on the command line
+    base_hyperparameters = dict()
+    for name in ["n_latent", "alpha", "beta", "gamma", "rho"]:
+        if getattr(args, name) != None:
+            base_hyperparameters[name] = getattr(args, name)
+
+    if (args.type=="image"):
+        data = {"n_chan": args.n_chan, "input_d": input_dimensions, "train": train_dataset, "val": validation_dataset, "test": test_dataset}
+    elif (args.type=="num"):
+        data = {"train": train_data, "val": val_data, "test": test_data, "train_labels": train_labels, "val_labels": val_labels, "test_labels": test_labels}
+
+    sweep = Sweep(args.model, args.type, args.search_space, base_hyperparameters, data, settings, args.sweep_dir, args.parallel_trials, args.threads_per_trial, args.min_epochs, args.max_epochs, args.eta)
+    sweep.run()
+
+memory_summary(settings)
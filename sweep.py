@@ -0,0 +1,179 @@
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import traceback
+import pandas as pd
+import torch
+
+from DCSAE.DCSAE_camaraderie import CAMARADERIE
+from DCSAE.DCSAE_camaraderie import NumCAMARADERIE
+from VAE.VAE_camaraderie import VAE_CAMARADERIE
+from VAE.VAE_camaraderie import VAE_NumCAMARADERIE
+from utils.data import available_cores
+
+# Datasets used by the trials of the current worker process, set once per process by init_worker()
+_trial_data = dict()
+
+def build_model(model: str, type: str, hyperparameters: dict, data: dict, directory: str, settings: dict):
+    # Creates the CAMARADERIE instance of a trial, every file written by the trial is stored in its own directory
+    encoder_weights_path = os.path.join(directory, 'enc_only_weights.pt')
+    weights_path = os.path.join(directory, 'weights.pt')
+    hyperparameters_path = os.path.join(directory, 'hyperparameters.pt')
+    h = hyperparameters
+    if (model == "dcsae"):
+        if (type == "image"):
+            return CAMARADERIE(data["n_chan"], data["input_d"], h["n_latent"], h["alpha"], h["beta"], h["gamma"], h["rho"], data["train"], data["val"], data["test"], encoder_weights_path, weights_path, hyperparameters_path, settings)
+        return NumCAMARADERIE(h["n_latent"], h["alpha"], h["beta"], h["gamma"], h["rho"], data["train"], data["val"], data["test"], data["train_labels"], data["val_labels"], data["test_labels"], encoder_weights_path, weights_path, hyperparameters_path, settings)
+    if (type == "image"):
+        return VAE_CAMARADERIE(data["n_chan"], data["input_d"], h["n_latent"], h["beta"], data["train"], data["val"], data["test"], encoder_weights_path, weights_path, hyperparameters_path, settings)
+    return VAE_NumCAMARADERIE(h["n_latent"], h["beta"], data["train"], data["val"], data["test"], data["train_labels"], data["val_labels"], data["test_labels"], encoder_weights_path, weights_path, hyperparameters_path, settings)
+
+def init_worker(threads: int, data: dict) -> None:
+    # Every worker process only uses its share of the cores, so that the trials running in parallel do not oversubscribe them
+    torch.set_num_threads(threads)
+    _trial_data.update(data)
+
+def run_trial(trial: dict, epochs: int, resume: bool, model: str, type: str, settings: dict) -> dict:
+    # Trains a trial up to the given number of epochs, continuing from the training state of its previous rung, and evaluates it
+    settings = dict(settings)
+    settings["epochs"] = epochs
+    settings["resume"] = resume
+    settings["checkpoint_every"] = 1
+    if settings.get("memory_report") is not None:
+        settings["memory_report"] = os.path.join(trial["directory"], 'memory.json') # Trials running in parallel do not share a report
+
+    result = dict(trial)
+    result["epochs"] = epochs
+    result["val_loss"] = math.inf
+    result["test_accuracy"] = None
+    with open(os.path.join(trial["directory"], 'log.txt'), 'a') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            camaraderie = build_model(model, type, trial["hyperparameters"], _trial_data, trial["directory"], settings)
+            camaraderie.train()
+            camaraderie.convert()
+            ClientB_features, ClientB_class = camaraderie.extract()
+            result["test_accuracy"] = camaraderie.classify(ClientB_features, ClientB_class) # Reported only, never used to select trials
+
+            # The best validation loss reached so far, which is also the loss of the weights that were evaluated
+            with open(os.path.join(trial["directory"], 'weights_metrics.jsonl')) as f:
+                result["val_loss"] = min(json.loads(line)["val_loss"] for line in f)
+        except Exception:
+            traceback.print_exc()
+            result["error"] = traceback.format_exc().splitlines()[-1]
+    return result
+
+def rank(result: dict):
+    # Trials are ranked by their validation loss, the test accuracy must not take part in the selection or it would be optimistically biased
+    return result["val_loss"]
+
+class Sweep:
+    def __init__(self, model, type, search_space_path, base_hyperparameters, data, settings, directory, parallel_trials=1, threads_per_trial=None, min_epochs=5, max_epochs=100, eta=3):
+        super(Sweep, self).__init__()
+        self.model = model
+        self.type = type
+        with open(search_space_path) as f:
+            self.search_space = json.load(f)
+        self.base_hyperparameters = base_hyperparameters
+        self.data = data
+        self.settings = dict(settings) if settings is not None else dict()
+        self.directory = directory
+        self.parallel_trials = parallel_trials
+        if self.settings.get("world_size", 1) > 1:
+            raise ValueError('Sweep trials run in forked pool processes and cannot train with world_size > 1')
+
+        # The cores are partitioned between the trials, every trial gets its share of the image loader workers (num_workers) and its
+        # threads are the cores of its share that are not used by its workers
+        cores = max(1, available_cores() // parallel_trials)
+        workers = 0
+        if type == "image":
+            workers = min((self.settings.get("num_workers") or 0) // parallel_trials, cores - 1)
+        self.settings["num_workers"] = workers
+        self.threads_per_trial = threads_per_trial if threads_per_trial != None else max(1, cores - workers)
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.eta = eta
+
+    def sample(self, space, rng: random.Random):
+        # A list is a set of choices, a dict is a range {"min", "max"} optionally sampled on a log scale ("log": true) or as integers ("int": true)
+        if isinstance(space, list):
+            return rng.choice(space)
+        if space.get("log", False):
+            value = math.exp(rng.uniform(math.log(space["min"]), math.log(space["max"])))
+        else:
+            value = rng.uniform(space["min"], space["max"])
+        return int(round(value)) if space.get("int", False) else value
+
+    def configurations(self) -> list:
+        # Search space format : {"method": "grid" or "random", "trials": 20, "seed": 0, "parameters": {"rho": [1, 2, 4], "alpha": {"min": 0.1, "max": 10, "log": true}}}
+        # Hyperparameters missing from the search space keep the values given on the command line
+        parameters = self.search_space["parameters"]
+        names = list(parameters)
+        if self.search_space.get("method", "grid") == "grid":
+            for name in names:
+                if not isinstance(parameters[name], list):
+                    raise ValueError(f'Grid search requires a list of values for {name}')
+            values = list(itertools.product(*[parameters[name] for name in names]))
+        else:
+            rng = random.Random(self.search_space.get("seed", 0))
+            values = [[self.sample(parameters[name], rng) for name in names] for _ in range(self.search_space.get("trials", 10))]
+        return [{**self.base_hyperparameters, **dict(zip(names, value))} for value in values]
+
+    def rungs(self) -> list:
+        # Successive halving : every rung trains the surviving trials for eta times more epochs than the previous rung
+        rungs = []
+        epochs = self.min_epochs
+        while epochs < self.max_epochs:
+            rungs.append(epochs)
+            epochs *= self.eta
+        rungs.append(self.max_epochs)
+        return rungs
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        trials = []
+        for i, hyperparameters in enumerate(self.configurations()):
+            directory = os.path.join(self.directory, f'trial-{i:03d}')
+            os.makedirs(directory, exist_ok=True)
+            trials.append({"trial": i, "directory": directory, "hyperparameters": hyperparameters})
+        rungs = self.rungs()
+        print(f'Running {len(trials)} trials with {self.parallel_trials} in parallel, {self.threads_per_trial} threads and {self.settings["num_workers"]} loader workers each, rungs at epochs {rungs}')
+
+        # The pool is forked, so the datasets already loaded by this process are passed to every worker only once
+        leaderboard = dict()
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(self.parallel_trials, mp_context=context, initializer=init_worker, initargs=(self.threads_per_trial, self.data)) as pool:
+            for rung, epochs in enumerate(rungs):
+                futures = [pool.submit(run_trial, trial, epochs, rung > 0, self.model, self.type, self.settings) for trial in trials]
+                results = sorted([future.result() for future in futures], key=rank)
+                for result in results:
+                    result["rung"] = rung
+                    leaderboard[result["trial"]] = result
+                    print(f'Rung {rung} ({epochs} epochs) : trial {result["trial"]} val_loss={result["val_loss"]} test_accuracy={result["test_accuracy"]} {result["hyperparameters"]}')
+                self.save(leaderboard)
+
+                # Only the best 1/eta of the trials are trained further
+                if rung < len(rungs) - 1:
+                    survivors = max(1, len(results) // self.eta)
+                    trials = [{"trial": r["trial"], "directory": r["directory"], "hyperparameters": r["hyperparameters"]} for r in results[:survivors]]
+        table = self.save(leaderboard)
+        print(table.to_string(index=False))
+        return table
+
+    def save(self, leaderboard: dict):
+        # Trials that reached a later rung are ranked first, then by validation loss
+        results = sorted(leaderboard.values(), key=lambda result: (-result["rung"], rank(result)))
+        rows = []
+        for result in results:
+            row = {"trial": result["trial"], "rung": result["rung"], "epochs": result["epochs"], "val_loss": result["val_loss"], "test_accuracy": result["test_accuracy"]}
+            row.update(result["hyperparameters"])
+            row["error"] = result.get("error")
+            row["directory"] = result["directory"]
+            rows.append(row)
+        table = pd.DataFrame(rows)
+        table.to_csv(os.path.join(self.directory, 'leaderboard.csv'), index=False)
+        return table
@@ -0,0 +1,25 @@
+from utils.memory import grows_linearly
+from utils.memory import memory_summary
+from utils.memory import save_report
+
+def record(stage, samples, peak_growth, retained_bytes=0, **details):
+    return {"stage": stage, **details, "samples": samples, "seconds": 0.0, "peak_rss": peak_growth, "peak_growth": peak_growth, "tensor_bytes_after": 0, "retained_bytes": retained_bytes}
+
+def test_two_sizes_are_not_a_linear_growth():
+    # A line through two points always has |r| = 1
+    runs = [[record('extract', 10, 1000)], [record('extract', 20, 2000)]]
+    assert not grows_linearly(runs)
+
+def test_three_sizes_with_linear_growth_are_flagged():
+    runs = [[record('extract', n, 4096 * n)] for n in [1000, 2000, 4000]]
+    assert grows_linearly(runs)
+
+def test_three_sizes_with_constant_growth_are_not_flagged():
+    runs = [[record('extract', n, 1 << 20)] for n in [1000, 2000, 4000]]
+    assert not grows_linearly(runs)
+
+def test_train_and_val_load_of_a_run_are_not_compared(tmp_path):
+    path = str(tmp_path / 'memory.json')
+    stages = [record('load', 20, 20 * 401408, 20 * 401408, dataset='train.csv'), record('load', 10, 10 * 401408, 10 * 401408, dataset='val.csv')]
+    save_report({"runs": [{"run": 'run', "argv": [], "running": None, "stages": stages}]}, path)
+    assert memory_summary({"memory_report": path, "memory_run": 'run'}) == dict()
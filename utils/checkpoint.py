@@ -0,0 +1,153 @@
+import os
+import random
+import signal
+import threading
+import numpy as np
+import torch
+
+from utils.distributed import any_process
+from utils.distributed import is_distributed
+from utils.distributed import rank
+
+def snapshot(state):
+    # Copy of a (possibly nested) state dict in CPU memory, so that later optimizer steps do not modify the saved values
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        copy = type(state)((key, snapshot(value)) for key, value in state.items())
+        metadata = getattr(state, '_metadata', None)
+        if metadata is not None:
+            copy._metadata = metadata
+        return copy
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+def atomic_save(obj, path: str) -> None:
+    # The object is written to a temporary file that replaces the destination only once it is complete
+    # A crash during the write leaves the previous file untouched
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class CheckpointWriter:
+    # Writes checkpoints to disk on a background thread so that the training loop never waits for disk I/O
+    # Only the latest checkpoint submitted for a path is written, older ones still waiting to be written are dropped
+    def __init__(self) -> None:
+        self.pending = dict()
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, state_dict, path: str) -> None:
+        copy = snapshot(state_dict)
+        with self.condition:
+            self.raise_error()
+            self.pending[path] = copy
+            self.condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                path, state_dict = self.pending.popitem()
+            try:
+                atomic_save(state_dict, path)
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+
+    def raise_error(self) -> None:
+        if self.error is not None:
+            raise RuntimeError('Writing a checkpoint failed') from self.error
+
+    def close(self) -> None:
+        # Waits until every pending checkpoint is written
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.raise_error()
+
+def training_state_path(weights_file: str) -> str:
+    # The full training state is stored next to the weights, e.g. weights.pt -> weights_training_state.pt
+    return f'{os.path.splitext(weights_file)[0]}_training_state.pt'
+
+def rng_state() -> dict:
+    state = dict()
+    state["torch"] = torch.get_rng_state()
+    state["cuda"] = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    state["numpy"] = np.random.get_state()
+    state["python"] = random.getstate()
+    return state
+
+def set_rng_state(state: dict) -> None:
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+
+def training_state(epoch: int, network: torch.nn.Module, optimizer: torch.optim.Optimizer) -> dict:
+    # Everything needed to continue training from the start of the given epoch
+    state = dict()
+    state["epoch"] = epoch
+    state["model"] = network.state_dict()
+    state["optimizer"] = optimizer.state_dict()
+    state["best_score"] = network.best_score
+    state["num_bad_epochs"] = network.num_bad_epochs
+    state["best_separation"] = getattr(network, 'best_separation', None)
+    state["num_bad_separation_epochs"] = getattr(network, 'num_bad_separation_epochs', 0)
+    state["rng"] = rng_state()
+    return state
+
+def restore_training_state(path: str, network: torch.nn.Module, optimizer: torch.optim.Optimizer) -> int:
+    # Restores a state saved by training_state() and returns the epoch from which training continues
+    state = torch.load(path, map_location='cpu')
+    network.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    network.best_score = state["best_score"]
+    network.num_bad_epochs = state["num_bad_epochs"]
+    if hasattr(network, 'best_separation'):
+        network.best_separation = state.get("best_separation")
+        network.num_bad_separation_epochs = state.get("num_bad_separation_epochs", 0)
+    set_rng_state(state["rng"])
+    if rank() > 0:
+        # The saved state is the one of rank 0, every other process is moved to its own stream so that it keeps drawing its own noise
+        torch.manual_seed(int(torch.randint(2**62, ())) + rank())
+    return state["epoch"]
+
+class TerminationHandler:
+    # Records SIGTERM instead of terminating the process immediately, so that the training loop can save its state first
+    # Signal handlers can only be installed from the main thread, elsewhere SIGTERM keeps its default behaviour
+    def __init__(self, poll_every: int = 50) -> None:
+        self.requested = False
+        self.previous = None
+        self.poll_every = poll_every
+        self.steps = 0
+        if threading.current_thread() is threading.main_thread():
+            self.previous = signal.signal(signal.SIGTERM, self.handle)
+
+    def handle(self, signum, frame) -> None:
+        self.requested = True
+
+    def poll(self) -> bool:
+        # Called after every training step, True in every process once SIGTERM was received by any of them
+        # In data-parallel training the processes only agree on it every poll_every steps, so that the training loop is not synchronized at every step
+        if not is_distributed():
+            return self.requested
+        self.steps += 1
+        return self.steps % self.poll_every == 0 and any_process(self.requested)
+
+    def restore(self) -> None:
+        if self.previous is not None:
+            signal.signal(signal.SIGTERM, self.previous)
+            self.previous = None
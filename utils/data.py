@@ -0,0 +1,147 @@
+import functools
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+import torchvision
+
+from utils.distributed import ShardSampler
+from utils.memory import MemoryStage
+
+# Images decoded and resized in this process, shared by training, validation and testing
+_ram_cache = dict()
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    def __init__(self, root: str, transform, n_chan: int, input_d, cache_dir: str = None) -> None:
+        super(CachedImageFolder, self).__init__()
+        self.folder = torchvision.datasets.ImageFolder(root=root, transform=transform)
+        self.samples = self.folder.samples
+        self.targets = self.folder.targets
+        self.classes = self.folder.classes
+        self.shape = (len(self.samples), n_chan, input_d[0], input_d[1])
+
+        # The cache is keyed by the dataset path, the modification time of every file and the output dimensions
+        key = self.cache_key(root, n_chan, input_d)
+        self.path = None
+        if cache_dir is None:
+            if key not in _ram_cache:
+                _ram_cache[key] = self.build(np.empty(self.shape, dtype=np.uint8))
+            self.images = _ram_cache[key]
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, f'{os.path.basename(os.path.normpath(root))}-{key[:16]}.npy')
+            if not os.path.exists(self.path):
+                # Writing to a temporary file first so that an interrupted build never leaves a corrupt cache behind
+                temp_path = self.path + '.tmp'
+                images = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=self.shape)
+                self.build(images)
+                images.flush()
+                del images
+                os.replace(temp_path, self.path)
+            self.images = np.load(self.path, mmap_mode='r')
+
+    def cache_key(self, root: str, n_chan: int, input_d) -> str:
+        files = [(os.path.relpath(path, root), os.stat(path).st_mtime_ns) for path, _ in self.samples]
+        description = json.dumps([os.path.abspath(root), n_chan, list(input_d), files])
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def build(self, images: np.ndarray) -> np.ndarray:
+        print(f'Caching {len(self.samples)} images of size {self.shape[1:]}')
+        for i in range(len(self.samples)):
+            image, _ = self.folder[i]
+            images[i] = torch.round(image * 255).to(torch.uint8).numpy()
+        return images
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __getitem__(self, index: int):
+        image = torch.from_numpy(np.array(self.images[index])).float().div(255)
+        return image, self.targets[index]
+
+    def __getstate__(self):
+        # Memory-mapped caches are re-opened by worker processes instead of being copied
+        state = self.__dict__.copy()
+        if self.path is not None:
+            del state['images']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.images = np.load(self.path, mmap_mode='r')
+
+def load_image_folder(root: str, transform, n_chan: int, input_d, settings: dict) -> torch.utils.data.Dataset:
+    # Image cache modes
+    # 1. none : Every image is decoded and resized each time it is read
+    # 2. ram : Every image is decoded and resized once and kept in memory as a uint8 array
+    # 3. disk : Same as ram, but the array is stored as a memory-mapped .npy file in the cache directory
+    mode = settings.get("image_cache", "none")
+    with MemoryStage(settings, 'load', dataset=root) as stage:
+        if mode == "ram":
+            dataset = CachedImageFolder(root, transform, n_chan, input_d)
+        elif mode == "disk":
+            dataset = CachedImageFolder(root, transform, n_chan, input_d, settings.get("cache_dir", "./cache"))
+        else:
+            dataset = torchvision.datasets.ImageFolder(root=root, transform=transform)
+        stage.samples = len(dataset)
+    return dataset
+
+def available_cores() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def default_num_workers() -> int:
+    # A quarter of the cores (at most 8) decode images, the remaining cores are left for the intra-op threads of the model
+    return max(0, min(8, available_cores() // 4))
+
+def reserve_loader_cores(num_workers: int) -> None:
+    # Leaving one core per loader worker so that decoding does not compete with the model
+    if num_workers > 0:
+        torch.set_num_threads(max(1, available_cores() - num_workers))
+
+def set_worker_affinity(worker_id: int, num_workers: int) -> None:
+    # Pinning every worker to its own core, counting from the last available core
+    cores = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cores[(len(cores) - num_workers + worker_id) % len(cores)]})
+    torch.set_num_threads(1)
+
+def collate_channels_last(batch):
+    # The images of a batch are converted to the channels_last layout once, in the loader workers, instead of by every convolution
+    input, class_name = torch.utils.data.default_collate(batch)
+    return input.contiguous(memory_format=torch.channels_last), class_name
+
+def make_loader(dataset: torch.utils.data.Dataset, batch_size: int, shuffle: bool, settings: dict) -> torch.utils.data.DataLoader:
+    num_workers = settings.get("num_workers")
+    if num_workers is None:
+        num_workers = default_num_workers()
+
+    # Options that are only valid when the images are loaded by worker processes
+    options = dict()
+    if num_workers > 0:
+        options["persistent_workers"] = settings.get("persistent_workers", True)
+        options["prefetch_factor"] = settings.get("prefetch_factor", 2)
+        if settings.get("worker_affinity", False) and hasattr(os, 'sched_setaffinity'):
+            options["worker_init_fn"] = functools.partial(set_worker_affinity, num_workers=num_workers)
+    if settings.get("channels_last", False):
+        options["collate_fn"] = collate_channels_last
+
+    # In data-parallel training every process loads its own shard of the dataset
+    # The training shards are padded so that all the processes run the same number of steps, the validation shards are not padded
+    # so that no sample is counted twice
+    sampler = None
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=True) if shuffle else ShardSampler(dataset)
+        shuffle = False
+
+    return torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        sampler=sampler,
+        drop_last=False,
+        num_workers=num_workers,
+        pin_memory=settings.get("pin_memory", False) and torch.cuda.is_available(),
+        **options)
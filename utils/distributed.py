@@ -0,0 +1,122 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import torch
+import torch.distributed as dist
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process() -> bool:
+    # Only the process with rank 0 decides on early stopping and writes files
+    return rank() == 0
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def run_worker(local_rank: int, function, processes: int, kwargs: dict) -> None:
+    dist.init_process_group('gloo', rank=local_rank, world_size=processes)
+    # The cores left to the model are shared by the processes, and every process draws its own noise for the reparameterization
+    torch.set_num_threads(max(1, torch.get_num_threads() // processes))
+    torch.manual_seed(torch.initial_seed() + local_rank)
+    try:
+        function(**kwargs)
+    finally:
+        dist.destroy_process_group()
+
+def launch(function, settings: dict, **kwargs) -> None:
+    # Runs function(**kwargs) in settings["world_size"] local processes that train together with DistributedDataParallel (gloo backend)
+    # The processes are forked, so the model and the datasets of this process are shared with them without being pickled
+    processes = settings.get("world_size", 1)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(free_port()))
+    context = torch.multiprocessing.start_processes(run_worker, args=(function, processes, kwargs), nprocs=processes, join=False, start_method='fork')
+
+    # SIGTERM received by this process is forwarded to the workers, so that they save their training state together
+    previous = None
+    if threading.current_thread() is threading.main_thread():
+        def forward_signal(signum, frame):
+            for process in context.processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+        previous = signal.signal(signal.SIGTERM, forward_signal)
+    try:
+        while not context.join():
+            pass
+    except torch.multiprocessing.ProcessExitedException as error:
+        if error.exit_code == 143: # A worker saved the training state after SIGTERM
+            sys.exit(143)
+        raise
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGTERM, previous)
+
+def distribute(network: torch.nn.Module) -> torch.nn.Module:
+    # Wraps the network with DistributedDataParallel when running in several processes, gradients are then averaged across them
+    if is_distributed():
+        return torch.nn.parallel.DistributedDataParallel(network)
+    return network
+
+def shard_permutation(n: int, epoch: int, device: torch.device) -> torch.Tensor:
+    # Shuffled indices of the samples processed by this process during an epoch
+    # All the processes draw the same permutation (seeded by the epoch) and take equally sized shares of it, so they run the same number of steps
+    if not is_distributed():
+        return torch.randperm(n, device=device)
+    generator = torch.Generator().manual_seed(epoch)
+    permutation = torch.randperm(n, generator=generator)[:n // world_size() * world_size()]
+    return permutation[rank()::world_size()].to(device)
+
+def shard(data: torch.Tensor) -> torch.Tensor:
+    # Share of the rows of a tensor processed by this process, used for validation
+    if not is_distributed():
+        return data
+    return data[rank()::world_size()]
+
+class ShardSampler(torch.utils.data.Sampler):
+    # Share of the samples of a dataset processed by this process, the same rows as shard(), used for validation
+    # Unlike DistributedSampler the shares are not padded, so every sample is counted exactly once when the results of the processes are summed
+    def __init__(self, dataset: torch.utils.data.Dataset) -> None:
+        self.indices = range(rank(), len(dataset), world_size())
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+def set_epoch(loader, epoch: int) -> None:
+    # A DistributedSampler only shuffles differently every epoch if it is told the epoch
+    if isinstance(loader.sampler, torch.utils.data.distributed.DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+    if is_distributed():
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+def any_process(flag: bool) -> bool:
+    # True in every process if the flag is set in at least one of them
+    if not is_distributed():
+        return flag
+    tensor = torch.tensor(int(flag))
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return bool(tensor.item())
+
+def broadcast_flag(flag: bool) -> bool:
+    # The value of the flag in the process with rank 0, in every process
+    if not is_distributed():
+        return flag
+    tensor = torch.tensor(int(flag))
+    dist.broadcast(tensor, src=0)
+    return bool(tensor.item())
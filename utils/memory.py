@@ -0,0 +1,210 @@
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import warnings
+import numpy as np
+import torch
+
+from utils.distributed import is_main_process
+
+# Stages of this process that are currently being measured, a nested stage must not hide the peak of the stages around it
+_active = []
+
+def rss() -> int:
+    # Resident set size of the process in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_rss()
+
+def peak_rss() -> int:
+    # Peak resident set size in bytes since the last reset_peak_rss(), or since the start of the process where it cannot be reset
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def reset_peak_rss() -> None:
+    # Linux resets the peak resident set size when 5 is written to clear_refs
+    for stage in _active:
+        stage.peak = max(stage.peak, peak_rss())
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def live_bytes() -> dict:
+    # Bytes held by the tensors and NumPy arrays that are still referenced, every storage is only counted once
+    # NumPy arrays are not tracked by the garbage collector, so they are found among the referents of the tracked containers
+    gc.collect()
+    storages = dict()
+    arrays = dict()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # isinstance() on some deprecated torch objects warns
+        for obj in gc.get_objects():
+            if isinstance(obj, torch.Tensor):
+                storage = obj.untyped_storage()
+                storages[(storage.device.type, storage.data_ptr())] = storage.nbytes()
+            elif isinstance(obj, (list, tuple, dict)):
+                for referent in gc.get_referents(obj):
+                    if isinstance(referent, np.ndarray) and referent.base is None:
+                        arrays[id(referent)] = referent.nbytes
+    return {"tensor_bytes": sum(storages.values()), "array_bytes": sum(arrays.values())}
+
+def load_report(path: str) -> dict:
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"runs": []}
+
+def save_report(report: dict, path: str) -> None:
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp, path)
+
+def current_run(report: dict, settings: dict) -> dict:
+    for run in report["runs"]:
+        if run["run"] == settings.get("memory_run"):
+            return run
+    run = {"run": settings.get("memory_run"), "argv": sys.argv[1:], "running": None, "stages": []}
+    report["runs"].append(run)
+    return run
+
+class MemoryStage:
+    # Records the resident set size (before, after and peak) and the live tensor and array bytes (before and after) of a pipeline stage
+    # The records are written to the JSON file settings["memory_report"] when the stage starts and when it ends, so that a stage killed
+    # by the OOM killer is still visible in the report as the stage that was running
+    # Without the setting every method does nothing, and in data-parallel training only rank 0 records its stages
+    def __init__(self, settings: dict, name: str, **details) -> None:
+        self.settings = settings
+        self.path = settings.get("memory_report") if is_main_process() else None
+        self.name = name
+        self.details = details
+        self.samples = None # Set inside a with block, passed to stop() otherwise
+
+    def start(self) -> None:
+        if self.path is None:
+            return
+        self.set_running(self.name)
+        self.before = live_bytes()
+        self.rss_before = rss()
+        reset_peak_rss()
+        self.peak = 0
+        _active.append(self)
+        self.start_time = time.perf_counter()
+
+    def stop(self, samples: int = None) -> None:
+        if self.path is None:
+            return
+        seconds = time.perf_counter() - self.start_time
+        _active.remove(self)
+        self.peak = max(self.peak, peak_rss())
+        rss_after = rss()
+        after = live_bytes()
+
+        record = {"stage": self.name, **self.details}
+        record["samples"] = samples
+        record["seconds"] = seconds
+        record["rss_before"] = self.rss_before
+        record["rss_after"] = rss_after
+        record["peak_rss"] = self.peak
+        record["peak_growth"] = self.peak - self.rss_before
+        for name in after:
+            record[f'{name}_before'] = self.before[name]
+            record[f'{name}_after'] = after[name]
+        record["retained_bytes"] = sum(after.values()) - sum(self.before.values())
+
+        report = load_report(self.path)
+        run = current_run(report, self.settings)
+        run["stages"].append(record)
+        run["running"] = None
+        save_report(report, self.path)
+
+    def set_running(self, name: str) -> None:
+        report = load_report(self.path)
+        current_run(report, self.settings)["running"] = name
+        save_report(report, self.path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop(self.samples)
+
+# Stages whose purpose is to keep the dataset in memory, so the bytes they keep alive are expected and only the fit across runs applies to them
+DATASET_STAGES = ['load']
+
+def stage_key(record: dict) -> tuple:
+    # Records of the same stage are only compared when they process the same dataset (e.g. the train and the val load stages are different)
+    return (record["stage"], record.get("dataset"))
+
+def grows_linearly(runs: list) -> str:
+    # Returns the reason why the memory of a stage grows linearly with the number of samples, or None
+    # runs holds the records of a single stage (see stage_key()), one list per run, so a run contributes a single point (its largest peak growth)
+    # With runs over at least 3 different numbers of samples, the peak growth of the stage is fitted against the number of samples
+    # (a line through 2 points always fits perfectly, so 2 sizes are not enough to tell a linear growth from a constant one)
+    # Otherwise, a stage that typically (median over the records of the last run) keeps at least one byte per sample alive after it ends
+    # (and at least 64 KiB) is flagged, so that a stage that only does so once (e.g. the first epoch, which creates the state of the optimizer) is not
+    points = []
+    for records in runs:
+        records = [record for record in records if record.get("samples")]
+        if records:
+            points.append((records[0]["samples"], max(record["peak_growth"] for record in records)))
+    if len(set(samples for samples, _ in points)) >= 3:
+        samples, growth = np.array(points, dtype=np.float64).T
+        slope, intercept = np.polyfit(samples, growth, 1)
+        correlation = np.corrcoef(samples, growth)[0, 1] if growth.std() > 0 else 0.0
+        if correlation >= 0.9 and slope > 0 and slope * samples.max() >= 0.5 * growth.max():
+            return f'peak grows by {slope:.0f} bytes per sample across runs (r={correlation:.2f})'
+        return None
+    records = [record for record in runs[-1] if record.get("samples")] if runs else []
+    if not records or records[0]["stage"] in DATASET_STAGES:
+        return None
+    samples = records[0]["samples"]
+    retained = float(np.median([record["retained_bytes"] for record in records]))
+    if retained >= max(samples, 64 * 1024):
+        return f'keeps {retained / samples:.0f} bytes per sample alive'
+    return None
+
+def memory_summary(settings: dict) -> dict:
+    # Prints the stages of this run and flags the stages whose memory grows linearly with the size of the dataset
+    path = settings.get("memory_report")
+    if path is None or not os.path.exists(path):
+        return dict()
+    report = load_report(path)
+    run = current_run(report, settings)
+    previous = [r for r in report["runs"] if r is not run]
+    for r in previous:
+        if r.get("running") is not None:
+            print(f'Run {r["run"]} ({" ".join(r["argv"])}) did not finish stage {r["running"]}')
+
+    print(f'{"Stage":<14}{"Samples":>10}{"Seconds":>10}{"Peak RSS (MB)":>15}{"Peak growth (MB)":>18}{"Live tensors (MB)":>19}{"Retained (MB)":>15}')
+    for record in run["stages"]:
+        samples = record["samples"] if record["samples"] is not None else '-'
+        print(f'{record["stage"]:<14}{samples:>10}{record["seconds"]:>10.2f}{record["peak_rss"]/2**20:>15.1f}{record["peak_growth"]/2**20:>18.1f}{record["tensor_bytes_after"]/2**20:>19.1f}{record["retained_bytes"]/2**20:>15.1f}')
+
+    # The current run is compared with the earlier runs, the records of every run are kept together
+    flags = dict()
+    for key in dict.fromkeys(stage_key(record) for record in run["stages"]):
+        runs = [[record for record in r["stages"] if stage_key(record) == key] for r in previous + [run]]
+        reason = grows_linearly([records for records in runs if records])
+        if reason is not None:
+            name = key[0] if key[1] is None else f'{key[0]} ({key[1]})'
+            flags[name] = reason
+            print(f'Memory of stage {name} grows linearly with the dataset size: {reason}')
+    run["linear"] = flags
+    save_report(report, path)
+    print(f'Memory report written to {path}')
+    return flags
@@ -0,0 +1,66 @@
+import json
+import os
+import torch
+
+from utils.distributed import all_reduce_sum
+from utils.distributed import is_main_process
+
+def metrics_path(weights_file: str) -> str:
+    # The metrics are stored next to the weights, e.g. weights.pt -> weights_metrics.jsonl
+    return f'{os.path.splitext(weights_file)[0]}_metrics.jsonl'
+
+class MetricsAggregator:
+    # Accumulates the loss components of every training step as detached tensors, so no autograd graph is kept alive
+    # They are converted to Python floats once per epoch, which is the only synchronization with the device
+    # In data-parallel training the sums of all the processes are combined and only rank 0 prints and writes them
+    def __init__(self, path: str = None, append: bool = False) -> None:
+        self.path = path if is_main_process() else None
+        if self.path is not None and not append:
+            open(self.path, 'w').close()
+        self.reset()
+
+    def reset(self) -> None:
+        self.sums = dict()
+        self.samples = 0
+        self.total_samples = 0
+        self.steps = 0
+
+    def update(self, batch_size: int, loss: torch.Tensor, **components) -> None:
+        # Every value is the mean over the batch, it is weighted by the batch size so that the epoch value is a mean over samples
+        components = {'Loss': loss, **components}
+        for name, value in components.items():
+            value = value.detach().float() * batch_size
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.samples += batch_size
+        self.steps += 1
+
+    def means(self) -> dict:
+        if self.samples == 0:
+            return dict()
+        sums = list(self.sums.values())
+        samples = torch.tensor(float(self.samples), device=sums[0].device)
+        values = all_reduce_sum(torch.stack(sums + [samples])).tolist()
+        self.total_samples = int(values.pop()) # Samples processed by all the processes
+        return {name: value / self.total_samples for name, value in zip(self.sums, values)}
+
+    def emit(self, epoch: int, val_loss: float, separation: float = None) -> dict:
+        # Prints the running means of the epoch, appends them to the metrics file and starts a new epoch
+        means = self.means()
+        components = ', '.join(f'{name}: {value}' for name, value in means.items() if name != 'Loss')
+        if is_main_process():
+            print(f'Epoch: {epoch}; Training Loss: {means.get("Loss")} ({components}); Validation Loss: {val_loss}' + (f'; Latent Separation: {separation}' if separation is not None else ''))
+
+        record = dict()
+        record["epoch"] = epoch
+        for name, value in means.items():
+            record[f'train_{name.lower()}'] = value
+        record["val_loss"] = val_loss
+        if separation is not None:
+            record["separation"] = separation
+        record["samples"] = self.total_samples
+        record["steps"] = self.steps
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        self.reset()
+        return record
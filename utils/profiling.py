@@ -0,0 +1,53 @@
+import os
+import torch
+
+from utils.distributed import is_main_process
+
+class StepProfiler:
+    # Records a window of steps of a loop (training steps or test batches) with torch.profiler when settings["profile"] is set
+    # The first profile_wait steps are skipped (the first one includes the time spent by torch.compile), the next profile_warmup steps are recorded and discarded,
+    # then profile_steps steps are recorded with operator-level time, memory allocations and input shapes
+    # The Chrome/Perfetto trace and the table of the top operators are written to profile_dir, named after the profiled loop
+    # Without the setting every method does nothing, and in data-parallel training only rank 0 is profiled
+    def __init__(self, settings: dict, name: str) -> None:
+        self.profiler = None
+        if not settings.get("profile", False) or not is_main_process():
+            return
+        self.name = name
+        self.directory = settings.get("profile_dir", "./profile")
+        self.top = settings.get("profile_top", 20)
+        self.sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        schedule = torch.profiler.schedule(wait=settings.get("profile_wait", 1), warmup=settings.get("profile_warmup", 1), active=settings.get("profile_steps", 5), repeat=1)
+        self.profiler = torch.profiler.profile(activities=activities, schedule=schedule, on_trace_ready=self.export, record_shapes=True, profile_memory=True)
+
+    def start(self) -> None:
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def step(self) -> None:
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def stop(self) -> None:
+        # A loop shorter than the window is exported with the steps recorded so far
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def export(self, profiler: torch.profiler.profile) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        trace_path = os.path.join(self.directory, f'{self.name}_trace.json')
+        table_path = os.path.join(self.directory, f'{self.name}_operators.txt')
+        profiler.export_chrome_trace(trace_path)
+
+        table = profiler.key_averages().table(sort_by=self.sort_by, row_limit=self.top)
+        shapes = profiler.key_averages(group_by_input_shape=True).table(sort_by=self.sort_by, row_limit=self.top)
+        with open(table_path, 'w') as f:
+            f.write(f'Top {self.top} operators of {self.name}\n{table}\n')
+            f.write(f'Top {self.top} operators of {self.name} by input shape\n{shapes}\n')
+        print(f'Top {self.top} operators of {self.name}')
+        print(table)
+        print(f'Profile of {self.name} written to {trace_path} and {table_path}')
@@ -0,0 +1,25 @@
+import torch
+
+def autocast(settings: dict):
+    # Precision modes
+    # 1. fp32 : Every operation runs in float32
+    # 2. bf16 : Matrix multiplications and convolutions run in bfloat16 through autocast, everything else stays in float32
+    device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.autocast(device_type, dtype=torch.bfloat16, enabled=settings.get("precision", "fp32") == "bf16")
+
+def compile_function(function, settings: dict):
+    # Wraps a module or a function with torch.compile when compilation is enabled, otherwise it is returned as it is
+    if settings.get("compile", False):
+        return torch.compile(function, mode=settings.get("compile_mode", "default"))
+    return function
+
+def memory_format(settings: dict) -> torch.memory_format:
+    # Memory layouts of the images and of the convolution weights
+    # 1. NCHW (default) : The channels of a pixel are stored apart from each other
+    # 2. channels_last : The channels of a pixel are stored next to each other (NHWC), which is the layout of the fastest oneDNN convolutions on CPU
+    # The layout of a tensor never changes its shape or its values, so flatten() and the losses give the same results in both layouts
+    return torch.channels_last if settings.get("channels_last", False) else torch.contiguous_format
+
+def chunk_rows(settings: dict, row_bytes: int) -> int:
+    # Number of rows encoded at once by the tabular encoders, so that the activations of a chunk fit in settings["extract_memory_mb"] megabytes
+    return max(1, settings.get("extract_memory_mb", 256) * 2**20 // row_bytes)
@@ -0,0 +1,33 @@
+from typing import Tuple
+import numpy as np
+import torch
+
+def sample_latent(mean: torch.Tensor, std: torch.Tensor, settings: dict, stream: int = 0) -> np.ndarray:
+    # Draws z = mean + std * eps for all the rows of the stacked (N x n_latent) tensors in a single step and returns one contiguous array
+    # Sampling modes (settings["latent_sampling"])
+    # 1. sample : eps is drawn from a generator seeded with settings["latent_seed"] + stream, Client A and Client B use different streams
+    # 2. mean : z is the mean itself, which makes the features deterministic
+    # With settings["latent_samples"] = K > 1, K draws are made for every row and the array has the shape (N x K x n_latent)
+    mean = mean.detach().float().cpu()
+    std = std.detach().float().cpu()
+    samples = settings.get("latent_samples", 1)
+    if settings.get("latent_sampling", "sample") == "mean":
+        return np.ascontiguousarray(mean.numpy())
+
+    generator = torch.Generator().manual_seed(settings.get("latent_seed", 0) + stream)
+    if samples > 1:
+        mean = mean.unsqueeze(1)
+        std = std.unsqueeze(1)
+    eps = torch.randn(mean.shape if samples == 1 else (mean.size(0), samples, mean.size(2)), generator=generator)
+    return np.ascontiguousarray((mean + std * eps).numpy())
+
+def flatten_draws(features: np.ndarray, labels: list) -> Tuple[np.ndarray]:
+    # Every draw of a sample becomes a row of the feature matrix and keeps the label of the sample
+    features = np.asarray(features)
+    draws = features.shape[1] if features.ndim == 3 else 1
+    return features.reshape(-1, features.shape[-1]), np.repeat(np.asarray(labels), draws)
+
+def majority_vote(predictions: np.ndarray, samples: int) -> np.ndarray:
+    # The predicted class of a sample is the class predicted for most of its draws (ties go to the positive class)
+    predictions = predictions.reshape(samples, -1)
+    return (predictions.mean(axis=1) >= 0.5).astype(predictions.dtype)
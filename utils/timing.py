@@ -0,0 +1,97 @@
+import json
+import os
+import time
+import numpy as np
+import torch
+
+from utils.distributed import all_reduce_sum
+from utils.distributed import is_main_process
+from utils.distributed import world_size
+
+# Phases that make up a training step, the other phases (validation, checkpoint) happen once per epoch
+STEP_PHASES = ['data', 'forward', 'backward', 'optimizer', 'bookkeeping']
+
+def timing_path(weights_file: str) -> str:
+    # The timings are stored next to the weights, e.g. weights.pt -> weights_timing.jsonl
+    return f'{os.path.splitext(weights_file)[0]}_timing.jsonl'
+
+class PhaseTimer:
+    # Wall-clock timers for the phases of training : data, forward (including the loss), backward, optimizer, bookkeeping (metrics, profiler and
+    # SIGTERM poll), validation and checkpoint
+    # Every call to lap() attributes the time elapsed since the previous call to a phase, so timing costs one perf_counter() per phase
+    # On a GPU the device is synchronized at every lap, otherwise the time of asynchronous kernels would be attributed to the wrong phase
+    # The first step with every batch size is reported separately from the steady state : with torch.compile (compiled=True) the first step
+    # includes the compilation, and the shorter last batch of an epoch triggers a recompilation the first time it is seen
+    def __init__(self, device: torch.device, path: str = None, append: bool = False, compiled: bool = False) -> None:
+        self.device = device
+        self.path = path if is_main_process() else None
+        if self.path is not None and not append:
+            open(self.path, 'w').close()
+        self.compiled = compiled
+        self.first_steps = dict() # Time of the first step with every batch size
+        self.steady_time = 0.0
+        self.steady_steps = 0
+        self.epoch_times = []
+
+    def start_epoch(self) -> None:
+        self.phases = {phase: 0.0 for phase in STEP_PHASES}
+        self.step_times = []
+        self.step_time = 0.0
+        self.samples = 0
+        self.epoch_start = self.mark = time.perf_counter()
+
+    def lap(self, phase: str) -> None:
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        elapsed = now - self.mark
+        self.mark = now
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+        if phase in STEP_PHASES:
+            self.step_time += elapsed
+
+    def end_step(self, batch_size: int) -> None:
+        self.step_times.append(self.step_time)
+        if batch_size not in self.first_steps:
+            self.first_steps[batch_size] = self.step_time
+        else:
+            self.steady_time += self.step_time
+            self.steady_steps += 1
+        self.step_time = 0.0
+        self.samples += batch_size
+
+    def end_epoch(self, epoch: int, epochs: int) -> dict:
+        # Prints the throughput of the epoch and appends it to the timing file
+        # In data-parallel training the throughput counts the samples of all the processes, the latencies and phases are the ones of this process
+        epoch_time = time.perf_counter() - self.epoch_start
+        total_samples = int(all_reduce_sum(torch.tensor(float(self.samples))))
+        self.epoch_times.append(epoch_time)
+        latencies = np.array(self.step_times) if self.step_times else np.zeros(1)
+
+        record = dict()
+        record["epoch"] = epoch
+        record["samples"] = total_samples
+        record["steps"] = len(self.step_times)
+        record["epoch_time"] = epoch_time
+        record["samples_per_sec"] = total_samples / epoch_time
+        record["world_size"] = world_size()
+        record["step_latency_mean"] = float(latencies.mean())
+        for percentile in [50, 90, 99]:
+            record[f'step_latency_p{percentile}'] = float(np.percentile(latencies, percentile))
+        record["phases"] = dict(self.phases)
+        record["eta"] = float(np.mean(self.epoch_times)) * (epochs - epoch - 1) # Seconds left if the remaining epochs take as long as the previous ones
+
+        if is_main_process():
+            phases = ', '.join(f'{phase}: {seconds:.2f} s' for phase, seconds in self.phases.items())
+            print(f'Epoch: {epoch}; {record["samples_per_sec"]:.1f} samples/s; Step: {1000*record["step_latency_mean"]:.2f} ms (p50 {1000*record["step_latency_p50"]:.2f}, p90 {1000*record["step_latency_p90"]:.2f}, p99 {1000*record["step_latency_p99"]:.2f}); {phases}; ETA: {record["eta"]:.0f} s')
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    def report(self) -> None:
+        label = ' (including compilation)' if self.compiled else ''
+        for batch_size, seconds in self.first_steps.items():
+            print(f'First training step with a batch of {batch_size}{label}: {seconds:.3f} s')
+        if self.steady_steps > 0:
+            print(f'Steady state: {1000*self.steady_time/self.steady_steps:.3f} ms per step over {self.steady_steps} steps')